@@ -7,17 +7,37 @@ Automatically update the Jira sheets in the Google Sheets document.
 
 import argparse
 import datetime
+import hashlib
 import os
+import sqlite3
+import time
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 
 import gspread
 import requests
 from dotenv import load_dotenv
 from oauth2client.service_account import ServiceAccountCredentials
-from utilities import backoff, get_previous_month
+from utilities import CACHE_DIRECTORY, backoff, create_session, get_previous_month
 
 load_dotenv()  # take environment variables from .env.
 
+# Number of JIRA queries to run concurrently for a month.
+MAX_WORKERS = 8
+
+# Keep connections to JIRA open across queries and retry rate-limited requests.
+SESSION = create_session(
+    pool_maxsize=MAX_WORKERS, auth=(os.getenv("ATLASSIAN_EMAIL"), os.getenv("ATLASSIAN_API_TOKEN"))
+)
+
+# JIRA sites where the approximate count endpoint is not available.
+APPROXIMATE_COUNT_UNSUPPORTED = set()
+
+# Issue counts are cached in SQLite, and refreshed after an hour while their month is in flight.
+METRICS_CACHE_PATH = os.path.join(CACHE_DIRECTORY, "jira_metrics.sqlite3")
+METRICS_CACHE_TTL = 3600
+
 STATUS_CHANGE_TEMPLATE = (
     'filter = "Filter for Insights" AND status changed TO ({})'
     " AFTER startOfMonth(-1) AND status changed TO ({}) BEFORE endOfMonth(-1)"
@@ -102,19 +122,22 @@ def get_google_credentials():
     return credentials
 
 
-def call_jira_api(jira_url, auth):
+def call_jira_api(jira_url, json_data=None):
     """
     Calls the JIRA API to get data.
 
     Args:
         jira_url (str): The JIRA API endpoint URL.
-        auth (tuple): The email and API token for authentication.
+        json_data (dict, optional): A JSON body to POST instead of making a GET request.
 
     Returns:
         dict: The JSON response from the JIRA API.
     """
     try:
-        response = requests.get(jira_url, auth=auth, timeout=30)
+        if json_data is None:
+            response = SESSION.get(jira_url, timeout=30)
+        else:
+            response = SESSION.post(jira_url, json=json_data, timeout=30)
         response.raise_for_status()
     except requests.exceptions.RequestException as error:
         print(f"Error: Unable to retrieve issue details. {error}")
@@ -122,52 +145,127 @@ def call_jira_api(jira_url, auth):
     return response.json()
 
 
-def get_issue_count(jql_query, max_results=1000):
+def get_approximate_issue_count(api_url, jql_query):
     """
-    Get issues from JIRA based on the JQL query provided.
+    Get the approximate number of issues in JIRA matching the JQL query provided.
 
     Args:
+        api_url (str): The JIRA site URL.
         jql_query (str): The JQL query.
-        max_results (int, optional): The maximum number of results to return. Defaults to 1000.
 
     Returns:
-        int: A number of issues if successful. Zero otherwise.
+        int: The approximate number of issues, or None if the JIRA site does not support it.
+    """
+    if api_url in APPROXIMATE_COUNT_UNSUPPORTED:
+        return None
+
+    try:
+        jira_url = f"{api_url}/rest/api/3/search/approximate-count"
+        return call_jira_api(jira_url, json_data={"jql": jql_query})["count"]
+    except requests.exceptions.HTTPError as error:
+        if error.response is None or error.response.status_code not in (404, 405):
+            raise
+        print("Approximate count is not available. Falling back to search.")
+        APPROXIMATE_COUNT_UNSUPPORTED.add(api_url)
+        return None
+
+
+def get_issue_count(jql_query):
+    """
+    Get the number of issues in JIRA matching the JQL query provided.
+
+    Uses the approximate count endpoint where the JIRA site supports it, which counts the
+    matches without running the full search. Otherwise, the search endpoint reports the total
+    number of matches, so a single request with ``maxResults=0`` and no fields is enough.
+
+    Args:
+        jql_query (str): The JQL query.
+
+    Returns:
+        int: A number of issues if successful. None otherwise.
     """
     api_token = os.getenv("ATLASSIAN_API_TOKEN")
     api_email = os.getenv("ATLASSIAN_EMAIL")
     api_url = os.getenv("ATLASSIAN_URL")
 
-
     if api_token is None or api_email is None or api_url is None:
         print("Error: ATLASSIAN_API_TOKEN, ATLASSIAN_EMAIL, and ATLASSIAN_URL must be set in the environment.")
-        return 0
+        return None
 
-    auth = (api_email, api_token)
-    encoded_query = urllib.parse.quote(jql_query)
+    try:
+        issue_count = get_approximate_issue_count(api_url, jql_query)
+        if issue_count is not None:
+            return issue_count
 
-    start_at = 0
-    count = 0
+        encoded_query = urllib.parse.quote(jql_query)
+        jira_url = f"{api_url}/rest/api/2/search?jql={encoded_query}&maxResults=0&fields="
+        issue_details = call_jira_api(jira_url)
+    except ValueError as error:
+        print(f"Error: Unable to parse response as JSON. {error}")
+        return None
 
-    while True:
-        jira_url = (
-            f"{api_url}/rest/api/2/search"
-            f"?jql={encoded_query}"
-            f"&startAt={start_at}"
-            f"&maxResults={max_results}"
-            "&fields=key"
-        )
+    return issue_details["total"]
 
-        try:
-            issue_details = call_jira_api(jira_url, auth)
-            count += len(issue_details["issues"])
-            if len(issue_details["issues"]) < max_results:
-                break  # we have fetched all issues
-            start_at += max_results  # prepare the start_at for the next set of issues
-        except ValueError as error:
-            print(f"Error: Unable to parse response as JSON. {error}")
-            return count
 
-    return count
+def connect_metrics_cache():
+    """
+    Opens the SQLite cache of issue counts, creating it if needed.
+
+    Returns:
+        sqlite3.Connection: The connection to the cache.
+    """
+    os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+    connection = sqlite3.connect(METRICS_CACHE_PATH, timeout=30)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS issue_counts"
+        " (query_hash TEXT, month TEXT, count INTEGER, fetched_at REAL, PRIMARY KEY (query_hash, month))"
+    )
+    return connection
+
+
+def get_cached_issue_count(jql_query, month):
+    """
+    Get the number of issues in JIRA matching the JQL query for a month, using the cached counts.
+
+    The queries are relative to today (``startOfMonth(-1)``), so they only measure a month while it
+    is the previous calendar month. Counts fetched then are cached for an hour, and are kept as the
+    month's final numbers for later runs once it has passed.
+
+    Args:
+        jql_query (str): The JQL query.
+        month (str): The month in the "YYYY-MM" format.
+
+    Returns:
+        int: A number of issues if successful. Zero otherwise.
+    """
+    query_hash = hashlib.sha1(jql_query.encode("utf-8")).hexdigest()
+    last_month = datetime.date.today().replace(day=1) - datetime.timedelta(days=1)
+    is_measured_month = month == last_month.strftime("%Y-%m")
+
+    with closing(connect_metrics_cache()) as connection:
+        cached = connection.execute(
+            "SELECT count, fetched_at FROM issue_counts WHERE query_hash = ? AND month = ?",
+            (query_hash, month),
+        ).fetchone()
+
+    if cached and (not is_measured_month or time.time() - cached[1] < METRICS_CACHE_TTL):
+        return cached[0]
+
+    issue_count = get_issue_count(jql_query)
+    # Failed counts are not cached, so they do not become the month's final numbers
+    if issue_count is None:
+        return 0
+
+    if is_measured_month:
+        with closing(connect_metrics_cache()) as connection:
+            # Commit the insert when the block ends
+            with connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO issue_counts VALUES (?, ?, ?, ?)",
+                    (query_hash, month, issue_count, time.time()),
+                )
+
+    return issue_count
 
 
 def fetch_and_update_metrics(months):
@@ -189,37 +287,61 @@ def fetch_and_update_metrics(months):
         month_datetime = datetime.datetime.strptime(month, "%Y-%m")
         month_formatted = month_datetime.strftime("%B %Y")
 
-        metrics_for_month = {}
-        for metric, jql_query in METRICS_QUERIES.items():
-            print(f"Fetching {metric} for {month_formatted}...")
-            print(f"JQL query: {jql_query}")
-            issue_count = get_issue_count(jql_query)
-            metrics_for_month[metric] = issue_count
+        futures = {}
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            for metric, jql_query in METRICS_QUERIES.items():
+                print(f"Fetching {metric} for {month_formatted}...")
+                print(f"JQL query: {jql_query}")
+                futures[metric] = executor.submit(get_cached_issue_count, jql_query, month)
 
-        metrics_data[month_formatted] = metrics_for_month
+        # Collect in query order so new metric rows are always added in the same order
+        metrics_data[month_formatted] = {metric: future.result() for metric, future in futures.items()}
 
-    # Find or create the columns for the months
-    all_months = [cell.value for cell in worksheet.range("2:2")]
+    # Read only the months in row 2 and the metrics in column B, both in a single request. They are
+    # kept up to date locally as new months and metrics are added, so they are never re-read.
+    month_row, metric_column = backoff(
+        worksheet.batch_get, args=(["2:2", "B:B"],), exceptions=gspread.exceptions.APIError
+    )
+    all_months = list(month_row[0]) if month_row else []
+    all_metrics = [row[0] if row else "" for row in metric_column]
+
+    # Map the names to their 1-indexed column and row, keeping the first if a name is repeated
+    month_columns = {}
+    for i, name in enumerate(all_months):
+        month_columns.setdefault(name, i + 1)
+    metric_rows = {}
+    for i, name in enumerate(all_metrics):
+        metric_rows.setdefault(name, i + 1)
+
+    # Collect every cell to write and send them to the sheet in a single request
+    cells = []
     for month, metrics in metrics_data.items():
-        if month not in all_months:
+        # Find or create the column for the month
+        if month not in month_columns:
             print(f"Adding column for {month}...")
             print(f"All months: {all_months}")
             all_months.append(month)
-            worksheet.update_cell(1, len(all_months), month)
+            month_columns[month] = len(all_months)
+            cells.append(gspread.Cell(2, month_columns[month], month))
 
-        month_column = all_months.index(month) + 1  # 1-indexed
+        month_column = month_columns[month]
 
         for metric, value in metrics.items():
             # Find or create the row for the metric
-            all_metrics = [cell.value for cell in worksheet.range("B:B")]
-            if metric not in all_metrics:
+            if metric not in metric_rows:
                 all_metrics.append(metric)
-                worksheet.update_cell(len(all_metrics), 2, metric)
+                metric_rows[metric] = len(all_metrics)
+                cells.append(gspread.Cell(metric_rows[metric], 2, metric))
 
-            metric_row = all_metrics.index(metric) + 1  # 1-indexed
+            cells.append(gspread.Cell(metric_rows[metric], month_column, value))
 
-            # Update the cell with the metric value
-            worksheet.update_cell(metric_row, month_column, value)
+    if cells:
+        backoff(
+            worksheet.update_cells,
+            args=(cells,),
+            kwargs={"value_input_option": "USER_ENTERED"},
+            exceptions=gspread.exceptions.APIError,
+        )
 
 
 def get_argument_parser():
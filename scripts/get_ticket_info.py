@@ -21,6 +21,7 @@ import os
 
 import requests
 from dotenv import load_dotenv
+from utilities import create_session
 
 # Load environment variables from .env file
 load_dotenv()
@@ -51,17 +52,20 @@ def main():
     # Set up authentication
     api_token = os.getenv("ATLASSIAN_API_TOKEN")
     api_email = os.getenv("ATLASSIAN_EMAIL")
-    if api_token is None or api_email is None:
-        print("Error: ATLASSIAN_API_TOKEN and ATLASSIAN_EMAIL must be set in the environment.")
+    api_url = os.getenv("ATLASSIAN_URL")
+    if api_token is None or api_email is None or api_url is None:
+        print(
+            "Error: ATLASSIAN_API_TOKEN, ATLASSIAN_EMAIL, and ATLASSIAN_URL must be set in the environment."
+        )
         return
-    auth = (api_email, api_token)
+    session = create_session(auth=(api_email, api_token))
 
     # Set up JIRA API URL and issue key
     jira_url = f"{api_url}/rest/api/2/issue/{args.issue_key}"
 
     # Send GET request to JIRA API
     try:
-        response = requests.get(jira_url, auth=auth, timeout=30)
+        response = session.get(jira_url, timeout=30)
         response.raise_for_status()
     except requests.exceptions.RequestException as error:
         print(f"Error: Unable to retrieve issue details. {error}")
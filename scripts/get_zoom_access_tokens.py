@@ -8,7 +8,7 @@ import base64
 import os
 import urllib.parse
 
-import requests
+from utilities import create_session
 
 # Your client id, client secret and redirect uri
 client_id = os.getenv("ZOOM_CLIENT_ID")
@@ -40,8 +40,8 @@ headers = {
 # Prepare the data
 data = {"grant_type": "authorization_code", "code": authorization_code, "redirect_uri": REDIRECT_URI}
 
-# Send the POST request
-response = requests.post(URL, headers=headers, data=data, timeout=10)
+# Send the POST request. An authorization code can only be used once, so it is never retried
+response = create_session(allowed_methods=("GET",)).post(URL, headers=headers, data=data, timeout=10)
 
 # If the request was successful, print the access and refresh tokens
 if response.status_code == 200:
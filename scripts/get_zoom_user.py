@@ -18,8 +18,8 @@ import argparse
 import base64
 import os
 
-import requests
 from dotenv import load_dotenv
+from utilities import create_session
 
 load_dotenv()  # take environment variables from .env.
 
@@ -32,20 +32,23 @@ client_id = os.getenv("ZOOM_S2S_CLIENT_ID")
 client_secret = os.getenv("ZOOM_S2S_CLIENT_SECRET")
 account_id = os.getenv("ZOOM_S2S_ACCOUNT_ID")
 
+# Reuse connections and retry rate-limited requests
+session = create_session()
+
 # Base64 encode client id and secret
 credentials = base64.b64encode(f"{client_id}:{client_secret}".encode("utf-8")).decode("utf-8")
 
 # Request access token
 headers = {"Authorization": f"Basic {credentials}"}
 data = {"grant_type": "account_credentials", "account_id": account_id}
-response = requests.post("https://zoom.us/oauth/token", headers=headers, data=data, timeout=10)
+response = session.post("https://zoom.us/oauth/token", headers=headers, data=data, timeout=10)
 access_token = response.json()["access_token"]
 
 # Use access token to authenticate API calls
 headers = {"Authorization": "Bearer " + access_token}
 
 # Call the Zoom API to get user information
-response = requests.get(f"https://api.zoom.us/v2/users/{args.username}", headers=headers, timeout=10)
+response = session.get(f"https://api.zoom.us/v2/users/{args.username}", headers=headers, timeout=10)
 
 # Check if user exists
 if response.status_code == 200:
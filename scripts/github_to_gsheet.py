@@ -7,22 +7,62 @@ Automatically update the Merges and Reviews sheets in the Google Sheets document
 
 import argparse
 import datetime
+import functools
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import gspread
-import pandas as pd
+import requests
 from cachetools import TTLCache, cached
 from dotenv import load_dotenv
 from github import Github, GithubException
 from oauth2client.service_account import ServiceAccountCredentials
-from utilities import backoff, get_month_range, get_previous_month
+from utilities import backoff, disk_cache, get_month_range, get_previous_month
 
 load_dotenv()  # take environment variables from .env.
 
+SPREADSHEET_ID = "1xREkcJwIP_iXblEkoTXoDqFWoLP7i6O2ZFdF2zn0tIA"
+
 # Define a cache that stores up to 1000 items and expires after 10 minutes.
 cache = TTLCache(maxsize=1000, ttl=600)
 
+# Reviewers and comment authors of pull requests seen during this run, keyed by repository and number.
+pull_request_cache = TTLCache(maxsize=4096, ttl=3600)
+pull_request_cache_lock = threading.Lock()
+
+# Number of pull requests to fetch from Github concurrently.
+MAX_WORKERS = 8
+
+GITHUB_GRAPHQL_URL = "https://api.github.com/graphql"
+
+# Searches for pull requests and returns everything needed to count merges, reviews, and
+# changes in the same response, so a page of pull requests costs a single request.
+PULL_REQUESTS_QUERY = """
+query($query: String!, $cursor: String) {
+  search(query: $query, type: ISSUE, first: 25, after: $cursor) {
+    issueCount
+    pageInfo { hasNextPage endCursor }
+    nodes {
+      ... on PullRequest {
+        number
+        additions
+        deletions
+        author { login }
+        repository { nameWithOwner }
+        reviews(first: 100) { totalCount nodes { author { login } } }
+        comments(first: 100) { totalCount nodes { author { login } } }
+        reviewThreads(first: 50) {
+          totalCount
+          nodes { comments(first: 50) { totalCount nodes { author { login } } } }
+        }
+      }
+    }
+  }
+}
+"""
+
 
 def get_credentials():
     """
@@ -48,17 +88,37 @@ def get_github_token():
     return os.getenv("GITHUB_TOKEN")
 
 
-def get_row_values(sheet, row):
+@functools.lru_cache(maxsize=1)
+def get_spreadsheet(credentials):
+    """
+    Authorizes with Google Sheets and opens the spreadsheet. The handle is memoized so the
+    authorization and lookup only happen once per run.
+
+    Args:
+        credentials (ServiceAccountCredentials): The Google Sheets credentials.
+
+    Returns:
+        gspread.Spreadsheet: The spreadsheet.
+    """
+    google = gspread.authorize(credentials)
+    return backoff(google.open_by_key, args=(SPREADSHEET_ID,))
+
+
+@functools.lru_cache(maxsize=None)
+def get_worksheet(credentials, sheet_name):
     """
-    Gets the values of a specific row from a Google Sheets document.
+    Gets a worksheet from the spreadsheet. The handle is memoized per sheet name.
 
-    :param sheet: (gspread.Spreadsheet) instance representing the Google Sheets document.
-    :param row: (int) representing the row number for which to get the values.
+    Args:
+        credentials (ServiceAccountCredentials): The Google Sheets credentials.
+        sheet_name (str): The name of the worksheet.
 
-    :return: List of cell values in the specified row.
-    :rtype: list
+    Returns:
+        gspread.Worksheet: The worksheet.
     """
-    return sheet.row_values(row)
+    return backoff(
+        get_spreadsheet(credentials).worksheet, args=(sheet_name,), exceptions=gspread.exceptions.APIError
+    )
 
 
 @cached(cache)
@@ -72,14 +132,50 @@ def get_user_aliases(credentials):
     Returns:
         dict: A dictionary with Github usernames as keys and full names as values.
     """
-    google = gspread.authorize(credentials)
-    spreadsheet = backoff(google.open_by_key, args=("1xREkcJwIP_iXblEkoTXoDqFWoLP7i6O2ZFdF2zn0tIA",))
-    usernames = pd.DataFrame(spreadsheet.worksheet("Aliases").get_all_records())
-    username_map = usernames.set_index("Username").to_dict()["Engineer - IC"]
+    header, *rows = backoff(
+        get_worksheet(credentials, "Aliases").get_values, exceptions=gspread.exceptions.APIError
+    )
+    username_index = header.index("Username")
+    name_index = header.index("Engineer - IC")
+    # Skip rows missing either the username or the full name, since they can never be credited
+    username_map = {
+        row[username_index]: row[name_index]
+        for row in rows
+        if len(row) > max(username_index, name_index) and row[username_index] and row[name_index]
+    }
 
     return username_map
 
 
+def cache_pull_request_history(function):
+    """
+    Decorator caching a function of a pull request in memory for this run and, once the pull
+    request is merged, on disk across runs since its reviews and comments can no longer change.
+
+    Args:
+        function (callable): The function taking a pull request to cache.
+
+    Returns:
+        callable: The cached function.
+    """
+
+    @cached(
+        pull_request_cache,
+        key=lambda pull: (function.__name__, pull.base.repo.full_name, pull.number),
+        lock=pull_request_cache_lock,
+    )
+    @functools.wraps(function)
+    def wrapper(pull):
+        if pull.merged_at is None:
+            return function(pull)
+
+        key = f"{function.__name__}:{pull.base.repo.full_name}#{pull.number}@{pull.merged_at.isoformat()}"
+        return disk_cache("github_pull_requests", key, function, args=(pull,))
+
+    return wrapper
+
+
+@cache_pull_request_history
 def get_all_pr_reviewers(pull):
     """
     Fetches all unique reviewers who approved the given pull request along with their review counts.
@@ -99,6 +195,7 @@ def get_all_pr_reviewers(pull):
     return review_authors
 
 
+@cache_pull_request_history
 def get_all_pr_comment_authors(pull):
     """
     Fetches all unique authors who commented on the given pull request along with their comment counts.
@@ -128,27 +225,26 @@ def get_all_pr_comment_authors(pull):
     return all_comment_authors
 
 
-def process_pull_request(pull, username_map):
+def tally_contributions(author_login, changes, comment_authors, review_authors, username_map):
     """
-    Process a single pull request.
+    Tallies the merges, reviews, and changes each known user contributed to a pull request.
 
     Args:
-        pull (PullRequest): The pull request object from PyGithub.
+        author_login (str): The Github username of the pull request author.
+        changes (int): The number of lines added and deleted by the pull request.
+        comment_authors (dict): Dictionary with Github usernames as keys and their comment counts as values.
+        review_authors (dict): Dictionary with Github usernames as keys and their review counts as values.
         username_map (dict): The mapping from Github username to full name.
 
     Returns:
         dict: A dictionary mapping each user to a dictionary with counts of merges, reviews, and changes.
     """
-    user_login = pull.user.login
-    user_full_name = username_map.get(user_login)
+    user_full_name = username_map.get(author_login)
 
     result = {}
 
     if user_full_name:
-        result[user_full_name] = {"merges": 1, "reviews": 0, "changes": pull.additions + pull.deletions}
-
-    comment_authors = get_all_pr_comment_authors(pull)
-    review_authors = get_all_pr_reviewers(pull)
+        result[user_full_name] = {"merges": 1, "reviews": 0, "changes": changes}
 
     all_contributors = set(list(comment_authors.keys()) + list(review_authors.keys()))
 
@@ -165,9 +261,232 @@ def process_pull_request(pull, username_map):
     return result
 
 
+def count_node_authors(nodes, excluded_login):
+    """
+    Counts the authors of GraphQL review or comment nodes.
+
+    Args:
+        nodes (list[dict]): The review or comment nodes.
+        excluded_login (str): The Github username to leave out, usually the pull request author.
+
+    Returns:
+        dict: Dictionary with Github usernames as keys and their counts as values.
+    """
+    authors = {}
+    for node in nodes:
+        # Deleted accounts have no author
+        login = (node["author"] or {}).get("login")
+        if login and login != excluded_login:
+            authors[login] = authors.get(login, 0) + 1
+
+    return authors
+
+
+def is_connection_complete(connection):
+    """
+    Checks whether a GraphQL connection holds all of its nodes.
+
+    Args:
+        connection (dict): The connection with its nodes and total count.
+
+    Returns:
+        bool: False if some of the nodes did not fit in the response.
+    """
+    return len(connection["nodes"]) == connection["totalCount"]
+
+
+def get_node_review_authors(node, author_login):
+    """
+    Counts the reviewers of a GraphQL pull request node.
+
+    Args:
+        node (dict): The pull request node from the GraphQL search.
+        author_login (str): The Github username of the pull request author.
+
+    Returns:
+        dict: Dictionary with Github usernames as keys and their review counts as values, or None
+              if not all of the reviews fit in the response.
+    """
+    if not is_connection_complete(node["reviews"]):
+        return None
+
+    return count_node_authors(node["reviews"]["nodes"], author_login)
+
+
+def get_node_comment_authors(node, author_login):
+    """
+    Counts the issue and review comment authors of a GraphQL pull request node.
+
+    Args:
+        node (dict): The pull request node from the GraphQL search.
+        author_login (str): The Github username of the pull request author.
+
+    Returns:
+        dict: Dictionary with Github usernames as keys and their comment counts as values, or None
+              if not all of the comments fit in the response.
+    """
+    threads = node["reviewThreads"]
+    connections = [node["comments"]] + [thread["comments"] for thread in threads["nodes"]]
+    if not is_connection_complete(threads) or not all(map(is_connection_complete, connections)):
+        return None
+
+    comments = [comment for connection in connections for comment in connection["nodes"]]
+    return count_node_authors(comments, author_login)
+
+
+def is_pull_request_node_complete(node):
+    """
+    Checks whether a GraphQL pull request node holds all of its reviews and comments.
+
+    Args:
+        node (dict): The pull request node from the GraphQL search.
+
+    Returns:
+        bool: False if any of the reviews or comments did not fit in the response.
+    """
+    return (
+        get_node_review_authors(node, None) is not None and get_node_comment_authors(node, None) is not None
+    )
+
+
+def process_pull_request_node(github, node, username_map):
+    """
+    Process a single pull request returned by the GraphQL search. Only the reviews or comments
+    that did not all fit in the search response are paged through over the REST API.
+
+    Args:
+        github (Github): The Github client.
+        node (dict): The pull request node from the GraphQL search.
+        username_map (dict): The mapping from Github username to full name.
+
+    Returns:
+        dict: A dictionary mapping each user to a dictionary with counts of merges, reviews, and changes.
+    """
+    author_login = (node["author"] or {}).get("login")
+
+    review_authors = get_node_review_authors(node, author_login)
+    comment_authors = get_node_comment_authors(node, author_login)
+
+    if review_authors is None or comment_authors is None:
+        repository = github.get_repo(node["repository"]["nameWithOwner"], lazy=True)
+        pull = repository.get_pull(node["number"])
+        if review_authors is None:
+            review_authors = get_all_pr_reviewers(pull)
+        if comment_authors is None:
+            comment_authors = get_all_pr_comment_authors(pull)
+
+    return tally_contributions(
+        author_login, node["additions"] + node["deletions"], comment_authors, review_authors, username_map
+    )
+
+
+def run_github_graphql_query(github_token, query, variables):
+    """
+    Runs a query against the Github GraphQL API.
+
+    Args:
+        github_token (str): The Github token.
+        query (str): The GraphQL query.
+        variables (dict): The variables for the query.
+
+    Returns:
+        dict: The data returned by the query.
+
+    Raises:
+        GithubException: If the query returned errors.
+    """
+    response = requests.post(
+        GITHUB_GRAPHQL_URL,
+        json={"query": query, "variables": variables},
+        headers={"Authorization": f"bearer {github_token}"},
+        timeout=60,
+    )
+    response.raise_for_status()
+    result = response.json()
+    if result.get("errors"):
+        raise GithubException(response.status_code, result["errors"], response.headers)
+
+    return result["data"]
+
+
+def search_pull_requests(github_token, query):
+    """
+    Searches for pull requests with the Github GraphQL API, following the result pages.
+
+    Args:
+        github_token (str): The Github token.
+        query (str): The Github search query.
+
+    Yields:
+        dict: The pull request nodes.
+    """
+    cursor = None
+    while True:
+        data = backoff(
+            run_github_graphql_query,
+            args=(github_token, PULL_REQUESTS_QUERY, {"query": query, "cursor": cursor}),
+            exceptions=(requests.exceptions.RequestException, GithubException),
+        )
+        search = data["search"]
+        if cursor is None:
+            print(f"Issues Found: {search['issueCount']}")
+
+        yield from search["nodes"]
+
+        if not search["pageInfo"]["hasNextPage"]:
+            break
+        cursor = search["pageInfo"]["endCursor"]
+
+
+def wait_for_rate_limit_reset(github):
+    """
+    Sleeps until the Github rate limit resets if it has been exhausted.
+
+    Args:
+        github (Github): The Github client.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    print(f"Current Time: {now}")
+    print("Rate limit exceeded. Waiting for reset...")
+    rate_limit = github.get_rate_limit()
+    print(f"Rate Limit: {rate_limit.core.limit}")
+    print(f"Rate Limit Remaining: {rate_limit.core.remaining}")
+    print(f"Rate Limit Reset Time: {rate_limit.core.reset}")
+    if rate_limit.core.remaining == 0:
+        reset_time_naive = rate_limit.core.reset
+        # Make it aware by associating it with the UTC timezone
+        reset_time = reset_time_naive.replace(tzinfo=datetime.timezone.utc)
+        sleep_time = (reset_time - now).total_seconds()
+        print(f"Rate limit exceeded, sleeping for {sleep_time} seconds")
+        time.sleep(abs(sleep_time))
+
+
+def fetch_pull_request_data(github, node, username_map):
+    """
+    Processes a single pull request that needs the REST API, waiting out the rate limit if it is hit.
+
+    Args:
+        github (Github): The Github client.
+        node (dict): The pull request node from the GraphQL search.
+        username_map (dict): The mapping from Github username to full name.
+
+    Returns:
+        dict: A dictionary mapping each user to a dictionary with counts of merges, reviews, and changes.
+    """
+    while True:
+        try:
+            return process_pull_request_node(github, node, username_map)
+        except GithubException as error:
+            if error.status != 403:
+                raise error
+            wait_for_rate_limit_reset(github)
+
+
 def fetch_github_data(github_token, username_map, month):
     """
-    Fetches Github data for a list of months.
+    Fetches Github data for a list of months. The pull requests come from a single GraphQL
+    search that includes their reviews and comments. Pull requests with more reviews or
+    comments than fit in that response are completed concurrently over the REST API.
 
     Args:
         github_token (str): The Github token.
@@ -178,48 +497,38 @@ def fetch_github_data(github_token, username_map, month):
         dict: A dictionary mapping each month to a tuple of three dictionaries representing
               merges, reviews, and changes respectively.
     """
-    github = Github(github_token)
+    merges = {user_full_name: 0 for user_full_name in username_map.values()}
+    reviews = {user_full_name: 0 for user_full_name in username_map.values()}
+    changes = {user_full_name: 0 for user_full_name in username_map.values()}
+
+    if not username_map:
+        print("No Github usernames to credit. Skipping the search.")
+        return merges, reviews, changes
+
+    github = Github(github_token, pool_size=MAX_WORKERS)
     org_name = os.getenv("GITHUB_ORG")
 
     start_date, end_date = get_month_range(date_input=month, output_format="date")
 
     query = f"org:{org_name} state:closed review:approved is:pr merged:{start_date}..{end_date}"
     print(f"Query: {query}")
-    issues = github.search_issues(query)
-    print(f"Issues Found: {issues.totalCount}")
 
-    merges = {user_full_name: 0 for user_full_name in username_map.values()}
-    reviews = {user_full_name: 0 for user_full_name in username_map.values()}
-    changes = {user_full_name: 0 for user_full_name in username_map.values()}
-    for issue in issues:
-        while True:
-            try:
-                pull = issue.repository.get_pull(issue.number)
-                data = process_pull_request(pull, username_map)
-
-                for user_full_name, counts in data.items():
-                    merges[user_full_name] += counts["merges"]
-                    reviews[user_full_name] += counts["reviews"]
-                    changes[user_full_name] += counts["changes"]
-                break
-            except GithubException as error:
-                if error.status == 403:
-                    now = datetime.datetime.now(datetime.timezone.utc)
-                    print(f"Current Time: {now}")
-                    print("Rate limit exceeded. Waiting for reset...")
-                    rate_limit = github.get_rate_limit()
-                    print(f"Rate Limit: {rate_limit.core.limit}")
-                    print(f"Rate Limit Remaining: {rate_limit.core.remaining}")
-                    print(f"Rate Limit Reset Time: {rate_limit.core.reset}")
-                    if rate_limit.core.remaining == 0:
-                        reset_time_naive = rate_limit.core.reset
-                        # Make it aware by associating it with the UTC timezone
-                        reset_time = reset_time_naive.replace(tzinfo=datetime.timezone.utc)
-                        sleep_time = (reset_time - now).total_seconds()
-                        print(f"Rate limit exceeded, sleeping for {sleep_time} seconds")
-                        time.sleep(abs(sleep_time))
-                else:
-                    raise error
+    results = []
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = []
+        for node in search_pull_requests(github_token, query):
+            if is_pull_request_node_complete(node):
+                results.append(process_pull_request_node(github, node, username_map))
+            else:
+                futures.append(executor.submit(fetch_pull_request_data, github, node, username_map))
+
+        results += [future.result() for future in as_completed(futures)]
+
+    for data in results:
+        for user_full_name, counts in data.items():
+            merges[user_full_name] += counts["merges"]
+            reviews[user_full_name] += counts["reviews"]
+            changes[user_full_name] += counts["changes"]
 
     print(f"merges: {merges}")
     print(f"reviews: {reviews}")
@@ -227,73 +536,115 @@ def fetch_github_data(github_token, username_map, month):
     return merges, reviews, changes
 
 
-def update_google_sheets(credentials, dataframe, sheet_name, month_converted):
+def update_google_sheets(credentials, sheet_counts, month_converted, pending_cells):
     """
-    Updates Google Sheets with Github data for a specific month.
+    Updates the Google Sheets with Github data for a specific month. All of the sheets are read
+    in a single request and any missing month columns are inserted in another. The values are
+    only queued so that every sheet and month can be written at once by 'write_pending_updates'.
 
     Args:
         credentials (ServiceAccountCredentials): The Google Sheets credentials.
-        dataframe (DataFrame): The dataframe containing the Github data.
-        sheet_name (str): The name of the Google Sheets document to be updated.
+        sheet_counts (dict): The Github data for each sheet, keyed by sheet name. Each maps an
+            engineer's full name to their count.
         month_converted (str): The month in 'Month Year' format.
+        pending_cells (dict): The cells queued for each sheet, keyed by sheet name. Queued cells
+            are shifted over when a column is inserted, and the new cells are added to it.
     """
-    google = gspread.authorize(credentials)
-    spreadsheet = backoff(google.open_by_key, args=("1xREkcJwIP_iXblEkoTXoDqFWoLP7i6O2ZFdF2zn0tIA",))
-    sheet = spreadsheet.worksheet(sheet_name)
-
-    headers = backoff(get_row_values, args=(sheet, 1), exceptions=gspread.exceptions.APIError)
-
-    if month_converted not in headers:
-        headers.insert(1, month_converted)
-        backoff(sheet.insert_cols, args=(2,), exceptions=gspread.exceptions.APIError)
-        backoff(sheet.update, args=("A1", [headers]), exceptions=gspread.exceptions.APIError)
-
-    column = headers.index(month_converted) + 1
-
-    # Fetch all data once and store in memory
-    data = backoff(sheet.get_all_values, exceptions=gspread.exceptions.APIError)
-
-    print(sheet_name)
-    print(dataframe)
-
-    for _, row in dataframe.iterrows():
-        user_rows = [i for i, row_values in enumerate(data) if row_values[0] == row["Engineer - IC"]]
-
-        if not user_rows:
-            continue
-
-        row_index = user_rows[0]
-
-        # Check if row_index is within the range of data
-        if row_index >= len(data):
-            data.append([""] * len(headers))
-
-        # Update in memory
-        if len(data[row_index]) < column:
-            data[row_index] += [""] * (column - len(data[row_index]))
-        data[row_index][column - 1] = int(row["count"])
-
+    spreadsheet = get_spreadsheet(credentials)
+
+    # Fetch all data of every sheet at once and store in memory
+    value_ranges = backoff(
+        spreadsheet.values_batch_get,
+        args=([f"'{sheet_name}'" for sheet_name in sheet_counts],),
+        exceptions=gspread.exceptions.APIError,
+    )["valueRanges"]
+
+    insert_requests = []
+    for (sheet_name, counts), value_range in zip(sheet_counts.items(), value_ranges):
+        data = value_range.get("values", [])
+        headers = data[0] if data else []
+        sheet_cells = pending_cells.setdefault(sheet_name, [])
+
+        # Headers queued earlier in the run are not on the sheet yet
+        for cell in sheet_cells:
+            if cell.row == 1:
+                headers += [""] * (cell.col - len(headers))
+                headers[cell.col - 1] = cell.value
+
+        if month_converted not in headers:
+            # The new column goes right after the names, so the rows read above stay valid
+            headers.insert(1, month_converted)
+            insert_requests.append(
+                {
+                    "insertDimension": {
+                        "range": {
+                            "sheetId": get_worksheet(credentials, sheet_name).id,
+                            "dimension": "COLUMNS",
+                            "startIndex": 1,
+                            "endIndex": 2,
+                        },
+                        "inheritFromBefore": False,
+                    }
+                }
+            )
+            sheet_cells[:] = [
+                gspread.Cell(cell.row, cell.col + 1 if cell.col >= 2 else cell.col, cell.value)
+                for cell in sheet_cells
+            ]
+            sheet_cells.append(gspread.Cell(1, 2, month_converted))
+
+        column = headers.index(month_converted) + 1
+
+        print(sheet_name)
+        print(counts)
+
+        # Index the rows by engineer name once, keeping the first row for each name
+        row_index_by_name = {}
+        for i, row_values in enumerate(data):
+            if row_values:
+                row_index_by_name.setdefault(row_values[0], i)
+
+        for user_full_name, count in counts.items():
+            row_index = row_index_by_name.get(user_full_name)
+
+            if row_index is None:
+                continue
+
+            sheet_cells.append(gspread.Cell(row_index + 1, column, int(count)))
+
+    if insert_requests:
         backoff(
-            sheet.update_cell,
-            args=(row_index + 1, column, data[row_index][column - 1]),
+            spreadsheet.batch_update,
+            args=({"requests": insert_requests},),
             exceptions=gspread.exceptions.APIError,
         )
 
 
-def transform_data_to_dataframe(data_dict):
+def write_pending_updates(credentials, pending_cells):
     """
-    Transforms a dictionary into a DataFrame.
+    Writes the queued cells of every sheet to Google Sheets, with one request for the month headers
+    and one for the counts. The headers are written raw, so Sheets keeps them as text instead of
+    parsing them as dates, and they still match the months they are looked up by.
 
     Args:
-        data_dict (dict): The dictionary containing the data.
-
-    Returns:
-        DataFrame: The DataFrame created from the data.
+        credentials (ServiceAccountCredentials): The Google Sheets credentials.
+        pending_cells (dict): The queued cells, keyed by sheet name.
     """
-    data_list = [
-        {"Engineer - IC": user_full_name, "count": count} for user_full_name, count in data_dict.items()
-    ]
-    return pd.DataFrame(data_list)
+    data_by_input_option = {"RAW": [], "USER_ENTERED": []}
+    for sheet_name, cells in pending_cells.items():
+        for cell in cells:
+            value_input_option = "RAW" if cell.row == 1 else "USER_ENTERED"
+            data_by_input_option[value_input_option].append(
+                {"range": f"'{sheet_name}'!{cell.address}", "values": [[cell.value]]}
+            )
+
+    for value_input_option, data in data_by_input_option.items():
+        if data:
+            backoff(
+                get_spreadsheet(credentials).values_batch_update,
+                kwargs={"body": {"valueInputOption": value_input_option, "data": data}},
+                exceptions=gspread.exceptions.APIError,
+            )
 
 
 def fetch_data(credentials, github_token, months):
@@ -315,6 +666,8 @@ def fetch_data(credentials, github_token, months):
     username_map = get_user_aliases(credentials)
     print(f"Username Map: {username_map}")
 
+    pending_cells = {}
+
     for month in months:
         print(f"Fetching Github data for {month}")
         merges, reviews, changes = fetch_github_data(github_token, username_map, month)
@@ -322,13 +675,14 @@ def fetch_data(credentials, github_token, months):
 
         month_converted = datetime.datetime.strptime(month, "%Y-%m").strftime("%B %Y")
 
-        merges_df = transform_data_to_dataframe(merges)
-        reviews_df = transform_data_to_dataframe(reviews)
-        changes_df = transform_data_to_dataframe(changes)
+        update_google_sheets(
+            credentials,
+            {"Merges": merges, "Reviews": reviews, "Code Changes": changes},
+            month_converted,
+            pending_cells,
+        )
 
-        update_google_sheets(credentials, merges_df, "Merges", month_converted)
-        update_google_sheets(credentials, reviews_df, "Reviews", month_converted)
-        update_google_sheets(credentials, changes_df, "Code Changes", month_converted)
+    write_pending_updates(credentials, pending_cells)
 
 
 def get_argument_parser():
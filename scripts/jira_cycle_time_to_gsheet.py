@@ -6,22 +6,39 @@ Automatically update the Jira sheets in the Google Sheets document.
 """
 
 import argparse
+import functools
 import os
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import gspread
+import numpy as np
 import pandas as pd
 import requests
 from dotenv import load_dotenv
 from oauth2client.service_account import ServiceAccountCredentials
-from utilities import backoff, get_month_range, get_previous_month
+from utilities import (
+    backoff,
+    create_session,
+    disk_cache,
+    get_month_range,
+    get_previous_month,
+    is_cell_unchanged,
+)
 
 load_dotenv()  # take environment variables from .env.
 
+SPREADSHEET_ID = "1f5xqsOXjS56k9NjUfZkFBHNlo4PMBKV9f_A0FHUf_1E"
 SHEET_NAME = "Cycle Time"
 URL = os.getenv("ATLASSIAN_URL")
 
+# Number of issue changelogs to fetch from JIRA concurrently, kept low to stay under the rate limits.
+MAX_WORKERS = 8
+
+# Shared session so concurrent requests reuse pooled connections to JIRA.
+SESSION = create_session(pool_maxsize=MAX_WORKERS)
+
 # Configurations for different issue types and their respective sheets in Google Sheets.
 SYNC_CONFIG = [
     {
@@ -80,6 +97,7 @@ STAGE_ORDER = [
     "Done",  # old
     "Declined",  # old
 ]
+STAGE_INDEX = {stage: index for index, stage in enumerate(STAGE_ORDER)}
 
 
 def get_google_credentials():
@@ -111,7 +129,7 @@ def call_jira_api(jira_url, auth):
         requests.exceptions.RequestException: If unable to retrieve issue details.
     """
     try:
-        response = requests.get(jira_url, auth=auth, timeout=30)
+        response = SESSION.get(jira_url, auth=auth, timeout=30)
         response.raise_for_status()
     except requests.exceptions.RequestException as error:
         print(f"Error: Unable to retrieve issue details. {error}")
@@ -142,7 +160,7 @@ def get_issue_with_changelog(issue_id, auth):
     """
     jira_url = (
         f"{URL}/rest/api/2/issue/{issue_id}"
-        f"?fields=key,created,resolutiondate"
+        f"?fields=key,created,updated,resolutiondate"
         "&expand=changelog"
     )
     issue_details = backoff(
@@ -156,13 +174,90 @@ def get_issue_with_changelog(issue_id, auth):
     return issue_details if issue_details else None
 
 
-def get_issues(jql_query, max_results=1000):
+def get_page_size(search_results, max_results):
     """
-    Get issues from JIRA based on the JQL query provided.
+    Gets the number of issues JIRA actually returns per page, which may be capped below the
+    number requested.
+
+    Args:
+        search_results (dict): The JSON response from the JIRA search API.
+        max_results (int): The number of issues requested per page.
+
+    Returns:
+        int: The number of issues per page to paginate by.
+    """
+    page_size = min(max_results, search_results.get("maxResults", max_results))
+    if page_size < max_results:
+        print(f"Warning: JIRA returns at most {page_size} issues per page instead of {max_results}.")
+    return page_size
+
+
+def complete_changelog(issue, auth):
+    """
+    Makes sure an issue from the search results holds its whole changelog, fetching the issue
+    again individually if some of the changelog did not fit in the search response. Resolved
+    issues are cached on disk by key and last update, so re-runs skip the refetch.
+
+    Args:
+        issue (dict): The issue from the search results.
+        auth (tuple): A tuple containing the email and API token for authentication.
+
+    Returns:
+        dict: The issue along with its changelog.
+    """
+    changelog = issue["changelog"]
+    if len(changelog["histories"]) >= changelog.get("total", 0):
+        return issue
+
+    if issue["fields"].get("resolutiondate") is None:
+        return get_issue_with_changelog(issue["key"], auth)
+
+    key = f"{issue['key']}:{issue['fields']['updated']}"
+    return disk_cache("jira_issues", key, get_issue_with_changelog, args=(issue["key"], auth))
+
+
+def get_search_page(encoded_query, start_at, max_results, auth):
+    """
+    Gets a single page of issues, including their changelogs, from the JIRA search API.
+
+    Args:
+        encoded_query (str): The URL encoded JQL query.
+        start_at (int): The index of the first issue to return.
+        max_results (int): The maximum number of issues to return.
+        auth (tuple): A tuple containing the email and API token for authentication.
+
+    Returns:
+        dict: The JSON response from the JIRA search API.
+    """
+    jira_url = (
+        f"{URL}/rest/api/2/search"
+        f"?jql={encoded_query}"
+        f"&startAt={start_at}"
+        f"&maxResults={max_results}"
+        "&fields=key,created,updated,resolutiondate"
+        "&expand=changelog"
+    )
+    return backoff(
+        call_jira_api,
+        args=(
+            jira_url,
+            auth,
+        ),
+        exceptions=requests.exceptions.RequestException,
+    )
+
+
+def get_issues(jql_query, max_results=100):
+    """
+    Get issues from JIRA based on the JQL query provided, including their changelogs.
+
+    The first page reports how many issues match, so the remaining pages are then fetched
+    concurrently. The changelogs are embedded in the search results. Only the issues whose
+    changelog did not fit in the search response are fetched again individually.
 
     Args:
         jql_query (str): The JQL query.
-        max_results (int, optional): The maximum number of results to return. Defaults to 1000.
+        max_results (int, optional): The maximum number of results to return per page. Defaults to 100.
 
     Returns:
         list: A list of issues if successful. None otherwise.
@@ -177,131 +272,172 @@ def get_issues(jql_query, max_results=1000):
     auth = (api_email, api_token)
     encoded_query = urllib.parse.quote(jql_query)
 
-    start_at = 0
     all_issues = []
 
-    while True:
-        jira_url = (
-            f"{URL}/rest/api/2/search"
-            f"?jql={encoded_query}"
-            f"&startAt={start_at}"
-            f"&maxResults={max_results}"
-            f"&fields=key"
-        )
-
-        try:
-            issues = backoff(
-                call_jira_api,
-                args=(
-                    jira_url,
-                    auth,
-                ),
-                exceptions=requests.exceptions.RequestException,
+    try:
+        first_page = get_search_page(encoded_query, 0, max_results, auth)
+        max_results = get_page_size(first_page, max_results)
+
+        # Fetch the remaining pages and then the issues with truncated changelogs concurrently,
+        # keeping the search order
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            pages = [first_page]
+            pages.extend(
+                executor.map(
+                    lambda start_at: get_search_page(encoded_query, start_at, max_results, auth),
+                    range(max_results, first_page["total"], max_results),
+                )
             )
-            for issue in issues["issues"]:
-                issue_id = issue["key"]
-                issue_details = get_issue_with_changelog(issue_id, auth)
-                all_issues.append(issue_details)
-
-            if len(issues["issues"]) < max_results:
-                break  # we have fetched all issues
-            start_at += max_results  # prepare the start_at for the next set of issues
-        except ValueError as error:
-            print(f"Error: Unable to parse response as JSON. {error}")
-            return []
+            for page in pages:
+                all_issues.extend(executor.map(lambda issue: complete_changelog(issue, auth), page["issues"]))
+    except ValueError as error:
+        print(f"Error: Unable to parse response as JSON. {error}")
+        return []
 
     return all_issues if all_issues else []
 
 
-def get_cycle_time(issue, start_stage, end_stage):
+def parse_jira_datetime(timestamp):
     """
-    Calculates the cycle time for a single issue.
+    Parses a JIRA timestamp such as 2024-01-15T13:22:11.123+0000 into an aware datetime.
 
     Args:
-        issue (dict): The issue for which the cycle time needs to be calculated.
+        timestamp (str): The timestamp returned by the JIRA API.
 
     Returns:
-        float: The cycle time in days.
+        datetime: The parsed timestamp.
     """
+    # fromisoformat is much faster than strptime but needs the offset written as +00:00
+    return datetime.fromisoformat(f"{timestamp[:-2]}:{timestamp[-2:]}")
 
-    changelog = issue["changelog"]
-    history = changelog["histories"]
 
-    # Initialize start_time to a future date and end_time to a past date
-    start_time = datetime.strptime(issue["fields"]["created"], "%Y-%m-%dT%H:%M:%S.%f%z")
-    end_time = datetime.strptime(issue["fields"]["resolutiondate"], "%Y-%m-%dT%H:%M:%S.%f%z")
+def flatten_status_changes(issues):
+    """
+    Flattens the status changes of all issues into NumPy arrays so cycle times can be reduced
+    without looping over the changelogs in Python.
 
-    for record in history:
-        if "items" in record:
-            for item in record["items"]:
-                if item["field"] != "status":
-                    continue
+    Args:
+        issues (list): The issues along with their changelogs.
 
-                if STAGE_ORDER.index(item["toString"]) <= STAGE_ORDER.index(start_stage):
-                    # Update start_time to the latest occurrence
-                    created_time = datetime.strptime(record["created"], "%Y-%m-%dT%H:%M:%S.%f%z")
-                    start_time = max(start_time, created_time)
+    Returns:
+        tuple: Arrays of the created and resolved timestamps of each issue, followed by arrays of
+               the issue position, stage index and timestamp of each status change.
+    """
+    created_times = np.empty(len(issues))
+    resolved_times = np.empty(len(issues))
+    issue_positions, stage_indexes, change_times = [], [], []
+
+    for position, issue in enumerate(issues):
+        created_times[position] = parse_jira_datetime(issue["fields"]["created"]).timestamp()
+        resolved_times[position] = parse_jira_datetime(issue["fields"]["resolutiondate"]).timestamp()
 
-                # Check if the item is in the same or a later stage than the end_stage
-                if STAGE_ORDER.index(item["toString"]) >= STAGE_ORDER.index(end_stage):
-                    # Update end_time to the earliest occurrence of the same or later stage
-                    created_time = datetime.strptime(record["created"], "%Y-%m-%dT%H:%M:%S.%f%z")
-                    end_time = min(end_time, created_time)
+        for record in issue["changelog"]["histories"]:
+            created_time = None
+            for item in record.get("items", []):
+                if item["field"] != "status":
+                    continue
 
-    return (end_time - start_time).total_seconds() / 86400  # convert to days
+                stage_index = STAGE_INDEX.get(item["toString"])
+                if stage_index is None:
+                    continue  # skip statuses outside the known workflow
+                if created_time is None:
+                    created_time = parse_jira_datetime(record["created"]).timestamp()
+
+                issue_positions.append(position)
+                stage_indexes.append(stage_index)
+                change_times.append(created_time)
+
+    return (
+        created_times,
+        resolved_times,
+        np.array(issue_positions, dtype=np.intp),
+        np.array(stage_indexes, dtype=np.int8),
+        np.array(change_times, dtype=np.float64),
+    )
 
 
 def calculate_cycle_time(issues, start_stage, end_stage):
     """
     Calculates the cycle time for a list of issues.
 
+    Each issue starts at the latest change to the start stage or an earlier one, or at its
+    creation, and ends at the earliest change to the end stage or a later one, or at its
+    resolution.
+
     Args:
         issues (list): The list of issues for which the cycle time needs to be calculated.
         start_stage (str): The start stage of the cycle.
         end_stage (str): The end stage of the cycle.
 
     Returns:
-        float: The average cycle time across all issues.
+        float: The average cycle time across all issues, in days.
     """
-    cycle_times = []
     print(f"Calculating cycle time for {len(issues)} issues.")
+    # Skip issues that could not be fetched or are missing their created or resolution dates
+    issues = [
+        issue
+        for issue in issues
+        if issue and issue["fields"].get("created") and issue["fields"].get("resolutiondate")
+    ]
+    if not issues:
+        return 0
+
+    start_times, end_times, issue_positions, stage_indexes, change_times = flatten_status_changes(issues)
+
+    starts = stage_indexes <= STAGE_INDEX[start_stage]
+    np.maximum.at(start_times, issue_positions[starts], change_times[starts])
+    ends = stage_indexes >= STAGE_INDEX[end_stage]
+    np.minimum.at(end_times, issue_positions[ends], change_times[ends])
+
+    return float(np.mean(end_times - start_times)) / 86400  # convert to days
 
-    cycle_times = [get_cycle_time(issue, start_stage, end_stage) for issue in issues]
-    # Remove None values from cycle_times list
-    cycle_times = [cycle_time for cycle_time in cycle_times if cycle_time is not None]
-    return sum(cycle_times) / len(cycle_times) if cycle_times else 0
 
+@functools.lru_cache(maxsize=1)
+def get_spreadsheet(credentials):
+    """
+    Authorizes with Google Sheets and opens the spreadsheet. The handle is memoized so the
+    authorization and lookup only happen once per run.
 
-def get_row_values(sheet, row):
+    Args:
+        credentials (ServiceAccountCredentials): The Google Sheets credentials.
+
+    Returns:
+        gspread.Spreadsheet: The spreadsheet.
     """
-    Gets the values of a specific row from a Google Sheets document.
+    google = gspread.authorize(credentials)
+    return backoff(google.open_by_key, args=(SPREADSHEET_ID,))
+
 
-    This function calls the row_values method on the provided gspread.Spreadsheet instance (sheet)
-    for a specific row number (row).
+@functools.lru_cache(maxsize=None)
+def get_worksheet(credentials, sheet_name):
+    """
+    Gets a worksheet from the spreadsheet. The handle is memoized per sheet name.
 
-    :param sheet: gspread.Spreadsheet instance representing the Google Sheets document.
-    :param row: Integer representing the row number for which to get the values.
+    Args:
+        credentials (ServiceAccountCredentials): The Google Sheets credentials.
+        sheet_name (str): The name of the worksheet.
 
-    :return: List of cell values in the specified row.
-    :rtype: list
+    Returns:
+        gspread.Worksheet: The worksheet.
     """
-    return sheet.row_values(row)
+    return backoff(
+        get_spreadsheet(credentials).worksheet, args=(sheet_name,), exceptions=gspread.exceptions.APIError
+    )
 
 
-def build_jql_query(month, issue_types, labels):
+def build_jql_query(start_date, end_date, issue_types, labels):
     """
     Builds a Jira Query Language (JQL) query based on given parameters.
 
     Args:
-        month (str): The month for which the data needs to be fetched, in 'YYYY-MM' format.
+        start_date (datetime.date): The first day of the month to fetch.
+        end_date (datetime.date): The last day of the month to fetch.
         issue_types (list): The types of issues that need to be fetched.
         labels (list): The labels that the issues must have.
 
     Returns:
         str: The JQL query string.
     """
-    start_date, end_date = get_month_range(date_input=month, output_format="date")
-
     jql_types = " OR ".join(f"issuetype={issue_type}" for issue_type in issue_types)
 
     jql_query = (
@@ -325,42 +461,42 @@ def update_google_sheets(credentials, dataframe, month_converted):
         dataframe (DataFrame): The DataFrame containing the data to be updated.
         month_converted (str): The month in 'Month Year' format.
     """
-    google = gspread.authorize(credentials)
-    spreadsheet = backoff(google.open_by_key, args=("1f5xqsOXjS56k9NjUfZkFBHNlo4PMBKV9f_A0FHUf_1E",))
-    sheet = spreadsheet.worksheet(SHEET_NAME)
+    sheet = get_worksheet(credentials, SHEET_NAME)
+
+    # Fetch all data once; the first row holds the headers. Values are read unformatted, so a cell
+    # displayed rounded is not mistaken for the new value.
+    data = backoff(
+        sheet.get_all_values,
+        kwargs={"value_render_option": "UNFORMATTED_VALUE"},
+        exceptions=gspread.exceptions.APIError,
+    )
+    headers = data[0] if data else []
 
-    headers = backoff(get_row_values, args=(sheet, 1), exceptions=gspread.exceptions.APIError)
+    # Find the first row of each type
+    type_rows = {}
+    for row_index, row_values in enumerate(data, start=1):
+        type_rows.setdefault(row_values[0], row_index)
 
     if month_converted not in headers:
         headers.insert(1, month_converted)
         backoff(sheet.insert_cols, args=(2,), exceptions=gspread.exceptions.APIError)
         backoff(sheet.update, args=("A1", [headers]), exceptions=gspread.exceptions.APIError)
+        data = []  # the new column is empty, so every value has to be written
 
     column = headers.index(month_converted) + 1
 
-    # Fetch all data once and store in memory
-    data = backoff(sheet.get_all_values, exceptions=gspread.exceptions.APIError)
-
-    for _, row in dataframe.iterrows():
-        type_rows = [i for i, row_values in enumerate(data) if row_values[0] == row["Type"]]
-
-        if not type_rows:
-            continue
-
-        row_index = type_rows[0]
-
-        # Check if row_index is within the range of data
-        if row_index >= len(data):
-            data.append([""] * len(headers))
-
-        # Update in memory
-        if len(data[row_index]) < column:
-            data[row_index] += [""] * (column - len(data[row_index]))
-        data[row_index][column - 1] = float(row[month_converted])
+    # Only write the values that differ from what the sheet already holds
+    cells = [
+        gspread.Cell(type_rows[row_type], column, float(cycle_time))
+        for row_type, cycle_time in zip(dataframe["Type"].tolist(), dataframe[month_converted].tolist())
+        if row_type in type_rows and not is_cell_unchanged(data, type_rows[row_type], column, cycle_time)
+    ]
 
+    if cells:
         backoff(
-            sheet.update_cell,
-            args=(row_index + 1, column, data[row_index][column - 1]),
+            sheet.update_cells,
+            args=(cells,),
+            kwargs={"value_input_option": "USER_ENTERED"},
             exceptions=gspread.exceptions.APIError,
         )
 
@@ -390,13 +526,19 @@ def main():
 
     for month in args.months:
         month_converted = datetime.strptime(month, "%Y-%m").strftime("%B %Y")
+        start_date, end_date = get_month_range(date_input=month, output_format="date")
         print(f"Fetching data for {month_converted}")
         data = []
+        # Configs with the same issue types and labels share one fetch
+        issues_by_group = {}
         for config in SYNC_CONFIG:
             print(f"Fetching data for {config['row_name']}")
-            jql_query = build_jql_query(month, config["issue_types"], config["labels"])
-            print(jql_query)
-            issues = get_issues(jql_query)
+            group = (tuple(sorted(config["issue_types"])), tuple(sorted(config["labels"])))
+            if group not in issues_by_group:
+                jql_query = build_jql_query(start_date, end_date, config["issue_types"], config["labels"])
+                print(jql_query)
+                issues_by_group[group] = get_issues(jql_query)
+            issues = issues_by_group[group]
             cycle_time = calculate_cycle_time(issues, config["start_stage"], config["end_stage"])
             data.append([config["row_name"], cycle_time])
 
@@ -7,18 +7,29 @@ Automatically update the Jira sheets in the Google Sheets document.
 
 import argparse
 import datetime
+import functools
 import os
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 
 import gspread
 import pandas as pd
 import requests
 from dotenv import load_dotenv
 from oauth2client.service_account import ServiceAccountCredentials
-from utilities import backoff, get_month_range, get_previous_month
+from utilities import backoff, create_session, get_month_range, get_previous_month, is_cell_unchanged
 
 load_dotenv()  # take environment variables from .env.
 
+SPREADSHEET_ID = "1xREkcJwIP_iXblEkoTXoDqFWoLP7i6O2ZFdF2zn0tIA"
+URL = os.getenv("ATLASSIAN_URL")
+
+# Number of search pages to fetch from JIRA concurrently, kept low to stay under the rate limits.
+MAX_WORKERS = 8
+
+# Shared session so concurrent searches reuse pooled connections to JIRA.
+SESSION = create_session(pool_maxsize=MAX_WORKERS)
+
 # Configurations for different issue types and their respective sheets in Google Sheets.
 SYNC_CONFIG = [
     {"issue_types": ["story"], "tab_name": "Stories", "labels": []},
@@ -58,7 +69,7 @@ def call_jira_api(jira_url, auth):
         requests.exceptions.RequestException: If unable to retrieve issue details.
     """
     try:
-        response = requests.get(jira_url, auth=auth, timeout=30)
+        response = SESSION.get(jira_url, auth=auth, timeout=30)
         response.raise_for_status()
     except requests.exceptions.RequestException as error:
         print(f"Error: Unable to retrieve issue details. {error}")
@@ -66,13 +77,65 @@ def call_jira_api(jira_url, auth):
     return response.json()
 
 
-def get_issues(jql_query, max_results=50):
+def get_page_size(search_results, max_results):
+    """
+    Gets the number of issues JIRA actually returns per page, which may be capped below the
+    number requested.
+
+    Args:
+        search_results (dict): The JSON response from the JIRA search API.
+        max_results (int): The number of issues requested per page.
+
+    Returns:
+        int: The number of issues per page to paginate by.
+    """
+    page_size = min(max_results, search_results.get("maxResults", max_results))
+    if page_size < max_results:
+        print(f"Warning: JIRA returns at most {page_size} issues per page instead of {max_results}.")
+    return page_size
+
+
+def get_search_page(encoded_query, start_at, max_results, auth):
+    """
+    Gets a single page of issues from the JIRA search API. Only the assignee field is requested
+    since it is all that gets tallied.
+
+    Args:
+        encoded_query (str): The URL encoded JQL query.
+        start_at (int): The index of the first issue to return.
+        max_results (int): The maximum number of issues to return.
+        auth (tuple): A tuple containing the email and API token for authentication.
+
+    Returns:
+        dict: The JSON response from the JIRA search API.
+    """
+    jira_url = (
+        f"{URL}/rest/api/2/search"
+        f"?jql={encoded_query}"
+        f"&startAt={start_at}"
+        f"&maxResults={max_results}"
+        "&fields=assignee"
+    )
+    return backoff(
+        call_jira_api,
+        args=(
+            jira_url,
+            auth,
+        ),
+        exceptions=requests.exceptions.RequestException,
+    )
+
+
+def get_issues(jql_query, max_results=100):
     """
     Get issues from JIRA based on the JQL query provided.
 
+    The first page reports how many issues match, so the remaining pages are then fetched
+    concurrently.
+
     Args:
         jql_query (str): The JQL query.
-        max_results (int, optional): The maximum number of results to return. Defaults to 50.
+        max_results (int, optional): The maximum number of results to return per page. Defaults to 100.
 
     Returns:
         list: A list of issues if successful. None otherwise.
@@ -87,51 +150,56 @@ def get_issues(jql_query, max_results=50):
     auth = (api_email, api_token)
     encoded_query = urllib.parse.quote(jql_query)
 
-    start_at = 0
-    all_issues = []
+    try:
+        first_page = get_search_page(encoded_query, 0, max_results, auth)
+        max_results = get_page_size(first_page, max_results)
+        all_issues = list(first_page["issues"])
+
+        # Fetch the remaining pages concurrently, keeping the search order
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            for page in executor.map(
+                lambda start_at: get_search_page(encoded_query, start_at, max_results, auth),
+                range(max_results, first_page["total"], max_results),
+            ):
+                all_issues.extend(page["issues"])
+    except ValueError as error:
+        print(f"Error: Unable to parse response as JSON. {error}")
+        return []
 
-    while True:
-        jira_url = (
-            f"{URL}/rest/api/2/search"
-            f"?jql={encoded_query}"
-            f"&startAt={start_at}"
-            f"&maxResults={max_results}"
-        )
+    return all_issues if all_issues else []
 
-        try:
-            issue_details = backoff(
-                call_jira_api,
-                args=(
-                    jira_url,
-                    auth,
-                ),
-                exceptions=requests.exceptions.RequestException,
-            )
-            all_issues.extend(issue_details["issues"])
-            if len(issue_details["issues"]) < max_results:
-                break  # we have fetched all issues
-            start_at += max_results  # prepare the start_at for the next set of issues
-        except ValueError as error:
-            print(f"Error: Unable to parse response as JSON. {error}")
-            return []
 
-    return all_issues if all_issues else []
+@functools.lru_cache(maxsize=1)
+def get_spreadsheet(credentials):
+    """
+    Authorizes with Google Sheets and opens the spreadsheet. The handle is memoized so the
+    authorization and lookup only happen once per run.
 
+    Args:
+        credentials (ServiceAccountCredentials): The Google Sheets credentials.
 
-def get_row_values(sheet, row):
+    Returns:
+        gspread.Spreadsheet: The spreadsheet.
     """
-    Gets the values of a specific row from a Google Sheets document.
+    google = gspread.authorize(credentials)
+    return backoff(google.open_by_key, args=(SPREADSHEET_ID,))
 
-    This function calls the row_values method on the provided gspread.Spreadsheet instance (sheet)
-    for a specific row number (row).
 
-    :param sheet: gspread.Spreadsheet instance representing the Google Sheets document.
-    :param row: Integer representing the row number for which to get the values.
+@functools.lru_cache(maxsize=None)
+def get_worksheet(credentials, sheet_name):
+    """
+    Gets a worksheet from the spreadsheet. The handle is memoized per sheet name.
 
-    :return: List of cell values in the specified row.
-    :rtype: list
+    Args:
+        credentials (ServiceAccountCredentials): The Google Sheets credentials.
+        sheet_name (str): The name of the worksheet.
+
+    Returns:
+        gspread.Worksheet: The worksheet.
     """
-    return sheet.row_values(row)
+    return backoff(
+        get_spreadsheet(credentials).worksheet, args=(sheet_name,), exceptions=gspread.exceptions.APIError
+    )
 
 
 def get_user_aliases(credentials):
@@ -141,28 +209,25 @@ def get_user_aliases(credentials):
     Returns:
         dict: A dictionary with usernames as keys and full names as values.
     """
-    google = gspread.authorize(credentials)
-    spreadsheet = backoff(google.open_by_key, args=("1xREkcJwIP_iXblEkoTXoDqFWoLP7i6O2ZFdF2zn0tIA",))
-    usernames = pd.DataFrame(spreadsheet.worksheet("Aliases").get_all_records())
+    usernames = pd.DataFrame(get_worksheet(credentials, "Aliases").get_all_records())
     username_map = usernames.set_index("Email").to_dict()["Engineer - IC"]
 
     return username_map
 
 
-def build_jql_query(month, issue_types, labels):
+def build_jql_query(start_date, end_date, issue_types, labels):
     """
     Builds a Jira Query Language (JQL) query based on given parameters.
 
     Args:
-        month (str): The month for which the data needs to be fetched, in 'YYYY-MM' format.
+        start_date (datetime.date): The first day of the month to fetch.
+        end_date (datetime.date): The last day of the month to fetch.
         issue_types (list): The types of issues that need to be fetched.
         labels (list): The labels that the issues must have.
 
     Returns:
         str: The JQL query string.
     """
-    start_date, end_date = get_month_range(date_input=month, output_format="date")
-
     jql_types = " OR ".join(f"issuetype={issue_type}" for issue_type in issue_types)
 
     jql_query = (
@@ -196,58 +261,102 @@ def get_jira_data(jql_query, email_map):
     if issues is None:
         return {}
 
+    emails = pd.Series(
+        [(issue["fields"].get("assignee") or {}).get("emailAddress") for issue in issues], dtype=object
+    ).dropna()
+    # Unknown assignees are counted under their email address
+    counts = emails.map(email_map).fillna(emails).value_counts()
+
     data = {user_full_name: 0 for user_full_name in email_map.values()}
-    for issue in issues or []:
-        assignee = issue["fields"]["assignee"]
-        if assignee is None or "emailAddress" not in assignee:
-            continue
-        assignee = issue["fields"]["assignee"]["emailAddress"]
-        user_full_name = email_map.get(assignee, assignee)
-        data[user_full_name] = data.get(user_full_name, 0) + 1
+    data.update(counts.to_dict())
     return data
 
 
-def update_google_sheets(credentials, dataframe, sheet_name, month_converted):
+def update_google_sheets(credentials, sheet_dataframes, month_converted):
     """
-    Updates a specified Google Sheets with the provided DataFrame.
+    Updates the Google Sheets with the provided DataFrames for a specific month. All of the sheets
+    are read in a single request, any missing month columns are inserted in another, and the new
+    month headers and the values are written in one more request each.
 
     Args:
         credentials (ServiceAccountCredentials): The Google Sheets credentials.
-        dataframe (DataFrame): The DataFrame containing the data to be updated.
-        sheet_name (str): The name of the sheet to be updated.
+        sheet_dataframes (dict): The DataFrame containing the data to be updated for each sheet,
+            keyed by sheet name.
         month_converted (str): The month in 'Month Year' format.
     """
-    google = gspread.authorize(credentials)
-    spreadsheet = backoff(google.open_by_key, args=("1xREkcJwIP_iXblEkoTXoDqFWoLP7i6O2ZFdF2zn0tIA",))
-    sheet = spreadsheet.worksheet(sheet_name)
-
-    headers = backoff(get_row_values, args=(sheet, 1), exceptions=gspread.exceptions.APIError)
-
-    if month_converted not in headers:
-        headers.insert(1, month_converted)
-        backoff(sheet.insert_cols, args=(2,), exceptions=gspread.exceptions.APIError)
-        backoff(sheet.update, args=("A1", [headers]), exceptions=gspread.exceptions.APIError)
-
-    column = headers.index(month_converted) + 1
+    spreadsheet = get_spreadsheet(credentials)
+
+    # Fetch all data of every sheet at once; the first row of each holds the headers. Values are read
+    # unformatted, so a cell displayed rounded is not mistaken for the new value.
+    value_ranges = backoff(
+        spreadsheet.values_batch_get,
+        args=([f"'{sheet_name}'" for sheet_name in sheet_dataframes],),
+        kwargs={"params": {"valueRenderOption": "UNFORMATTED_VALUE"}},
+        exceptions=gspread.exceptions.APIError,
+    )["valueRanges"]
+
+    insert_requests = []
+    cells = []
+    for (sheet_name, dataframe), value_range in zip(sheet_dataframes.items(), value_ranges):
+        data = value_range.get("values", [])
+        headers = data[0] if data else []
+
+        # Find the first row of each engineer
+        user_rows = {}
+        for row_index, row_values in enumerate(data, start=1):
+            if row_values:
+                user_rows.setdefault(row_values[0], row_index)
+
+        if month_converted not in headers:
+            # The new column goes right after the names, so the rows read above stay valid
+            headers.insert(1, month_converted)
+            insert_requests.append(
+                {
+                    "insertDimension": {
+                        "range": {
+                            "sheetId": get_worksheet(credentials, sheet_name).id,
+                            "dimension": "COLUMNS",
+                            "startIndex": 1,
+                            "endIndex": 2,
+                        },
+                        "inheritFromBefore": False,
+                    }
+                }
+            )
+            cells.append((sheet_name, gspread.Cell(1, 2, month_converted)))
+            data = []  # the new column is empty, so every value has to be written
 
-    for _, row in dataframe.iterrows():
-        data = backoff(sheet.get_all_values, exceptions=gspread.exceptions.APIError)
-        user_rows = [i for i, row_values in enumerate(data) if row_values[0] == row["Engineer - IC"]]
+        column = headers.index(month_converted) + 1
 
-        if not user_rows:
-            continue
+        # Only write the values that differ from what the sheet already holds
+        cells.extend(
+            (sheet_name, gspread.Cell(user_rows[user_full_name], column, count))
+            for user_full_name, count in zip(dataframe["Engineer - IC"].tolist(), dataframe["count"].tolist())
+            if user_full_name in user_rows
+            and not is_cell_unchanged(data, user_rows[user_full_name], column, count)
+        )
 
-        row_index = user_rows[0] + 1
+    if insert_requests:
         backoff(
-            sheet.update_cell,
-            args=(
-                row_index,
-                column,
-                row["count"],
-            ),
+            spreadsheet.batch_update,
+            args=({"requests": insert_requests},),
             exceptions=gspread.exceptions.APIError,
         )
 
+    # Write the month headers raw, so Sheets keeps them as text instead of parsing them as dates
+    for value_input_option, is_header in (("RAW", True), ("USER_ENTERED", False)):
+        data = [
+            {"range": f"'{sheet_name}'!{cell.address}", "values": [[cell.value]]}
+            for sheet_name, cell in cells
+            if (cell.row == 1) == is_header
+        ]
+        if data:
+            backoff(
+                spreadsheet.values_batch_update,
+                kwargs={"body": {"valueInputOption": value_input_option, "data": data}},
+                exceptions=gspread.exceptions.APIError,
+            )
+
 
 def transform_data_to_dataframe(data_dict):
     """
@@ -264,7 +373,7 @@ def transform_data_to_dataframe(data_dict):
     data_list = [
         {"Engineer - IC": user_full_name, "count": count} for user_full_name, count in data_dict.items()
     ]
-    return pd.DataFrame(data_list)
+    return pd.DataFrame(data_list, columns=["Engineer - IC", "count"])
 
 
 def get_argument_parser():
@@ -293,21 +402,26 @@ def main():
 
     for month in args.months:
         month_converted = datetime.datetime.strptime(month, "%Y-%m").strftime("%B %Y")
+        start_date, end_date = get_month_range(date_input=month, output_format="date")
 
+        sheet_dataframes = {}
         for config in SYNC_CONFIG:
             print(f"Getting data for {' and '.join(config['issue_types'])} during {month}")
             jql_query = build_jql_query(
-                month=month, issue_types=config["issue_types"], labels=config["labels"]
+                start_date=start_date,
+                end_date=end_date,
+                issue_types=config["issue_types"],
+                labels=config["labels"],
             )
             data = get_jira_data(jql_query=jql_query, email_map=email_map)
-            dataframe = transform_data_to_dataframe(data)
-            print(f"Writing data for {' and '.join(config['issue_types'])} during {month}")
-            update_google_sheets(
-                credentials=google_credentials,
-                dataframe=dataframe,
-                sheet_name=config["tab_name"],
-                month_converted=month_converted,
-            )
+            sheet_dataframes[config["tab_name"]] = transform_data_to_dataframe(data)
+
+        print(f"Writing data for {month}")
+        update_google_sheets(
+            credentials=google_credentials,
+            sheet_dataframes=sheet_dataframes,
+            month_converted=month_converted,
+        )
 
 
 if __name__ == "__main__":
@@ -7,17 +7,25 @@ the summary to two users via Slack.
 """
 
 import datetime
+import functools
 import os
+import re
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Tuple, Union
 
 import gspread
 import openai
 import pandas as pd
+import tiktoken
 from dotenv import load_dotenv
+from gspread.utils import fill_gaps
 from oauth2client.service_account import ServiceAccountCredentials
 from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
-from utilities import backoff
+from slack_sdk.http_retry.builtin_handlers import RateLimitErrorRetryHandler
+from utilities import backoff, disk_cache
 
 # Load environment variables
 load_dotenv()
@@ -25,6 +33,15 @@ load_dotenv()
 SLACK_TOKEN = os.getenv("SLACK_BOT_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
+# One client for every message so its connection is reused. Rate limited messages are retried
+# after the Retry-After delay Slack asks for.
+SLACK_CLIENT = WebClient(token=SLACK_TOKEN)
+SLACK_CLIENT.retry_handlers.append(RateLimitErrorRetryHandler(max_retry_count=3))
+
+# Slack allows about one chat.postMessage per second per channel
+SLACK_MESSAGE_INTERVAL = 1.0
+LAST_MESSAGE_TIMES: Dict[str, float] = {}
+
 # Slack users to notify
 MANAGERS = {
     "Dan Greff": "U02UKASPJJ0",
@@ -119,36 +136,39 @@ GOOGLE_SHEETS_CONFIG = [
 
 DATA_FRAME_INDEX_TO_NAME = []
 
+# Number of prompts to summarize concurrently, kept low to stay under the OpenAI rate limits
+OPENAI_MAX_WORKERS = 3
+
 # 4000, 8000, 16000, or 32000 depending on the model
 MAX_TOKENS = 4000
-MODEL = "gpt-4"
+MODEL = "gpt-4o-mini"
+ENCODING = tiktoken.encoding_for_model(MODEL)
 
 
 def count_tokens(text: str) -> int:
-    """Count the number of tokens in a text string."""
-    return len(text.split())
+    """Count the number of tokens the model will see in a text string."""
+    return len(ENCODING.encode(text))
 
 
-def get_anon_dict(sheet_id: str, sheet_name: str) -> Tuple[Dict[str, str], Dict[str, str], Dict[str, str]]:
-    """Fetches data from a Google Sheet and creates an anonymization dictionary."""
-    scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
-    credentials = ServiceAccountCredentials.from_json_keyfile_name("google-credentials.json", scope)
-    client = gspread.authorize(credentials)
-
-    sheet = client.open_by_key(sheet_id)
-    worksheet = sheet.worksheet(sheet_name)
-    data = worksheet.get_all_records()  # fetch all data as a list of dictionaries
+def build_anon_dicts(
+    sheet: gspread.Spreadsheet, sheet_name: str
+) -> Tuple[Dict[str, str], Dict[str, str], Dict[str, str]]:
+    """Reads the aliases worksheet and creates the anonymization dictionaries from it."""
+    worksheet = backoff(sheet.worksheet, args=(sheet_name,))
+    data = backoff(worksheet.get_all_values)  # fetch all data as a list of rows
 
     anon_dict = {}
     deanon_dict = {}
     anon_to_manager_dict = {}
 
-    for index, row in enumerate(data):
-        if index == 0:
-            continue  # Skip the header row
-        ic_name = row["Engineer - IC"]
+    headers = data[0]
+    ic_index = headers.index("Engineer - IC")
+    manager_index = headers.index("Manager")
+
+    for index, row in enumerate(data[1:], start=1):  # Skip the header row
+        ic_name = row[ic_index]
         anon_name = f"Anon{index}"
-        manager = row["Manager"]
+        manager = row[manager_index]
         anon_dict[ic_name] = anon_name
         deanon_dict[anon_name] = ic_name
         anon_to_manager_dict[anon_name] = manager
@@ -156,6 +176,20 @@ def get_anon_dict(sheet_id: str, sheet_name: str) -> Tuple[Dict[str, str], Dict[
     return anon_dict, deanon_dict, anon_to_manager_dict
 
 
+def get_anon_dict(sheet_id: str, sheet_name: str) -> Tuple[Dict[str, str], Dict[str, str], Dict[str, str]]:
+    """
+    Fetches data from a Google Sheet and creates an anonymization dictionary. The dictionaries are
+    cached on disk until the spreadsheet is next modified, so unchanged aliases are not read again.
+    """
+    scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
+    credentials = ServiceAccountCredentials.from_json_keyfile_name("google-credentials.json", scope)
+    client = gspread.authorize(credentials)
+
+    sheet = backoff(client.open_by_key, args=(sheet_id,))
+    key = f"{sheet_id}:{sheet_name}:{sheet.lastUpdateTime}"
+    return disk_cache("anonymization", key, build_anon_dicts, args=(sheet, sheet_name))
+
+
 def get_google_sheets_data(
     sheets_config: List[Dict[str, Union[str, List[Dict[str, str]]]]],
     anon_dict: Dict[str, str],
@@ -166,65 +200,86 @@ def get_google_sheets_data(
     client = gspread.authorize(credentials)
 
     data_frames = []
-
-    index = 0
     for sheet_config in sheets_config:
-        sheet_id = sheet_config["sheet_id"]
-        tabs = sheet_config["tabs"]
-        sheet = backoff(client.open_by_key, args=(sheet_id,))
-        for tab_config in tabs:
-            tab_name = tab_config["tab_name"]
-            data_frame_name = tab_config["data_frame_name"]
-            worksheet = next((ws for ws in sheet.worksheets() if ws.title == tab_name), None)
-            if worksheet:
-                data = backoff(
-                    worksheet.get_all_values,
-                )
-            else:
+        sheet = backoff(client.open_by_key, args=(sheet_config["sheet_id"],))
+        # List the worksheets once per spreadsheet and look the tabs up by title
+        worksheet_titles = {ws.title for ws in backoff(sheet.worksheets)}
+        tab_names = [tab_config["tab_name"] for tab_config in sheet_config["tabs"]]
+        for tab_name in tab_names:
+            if tab_name not in worksheet_titles:
                 raise ValueError(f"Worksheet '{tab_name}' not found in the spreadsheet.")
-            sheet_data_frame = pd.DataFrame(data)
+
+        # Read all the tabs of the spreadsheet in a single request, in the configured order
+        ranges = [f"'{tab_name}'" for tab_name in tab_names]
+        response = backoff(sheet.values_batch_get, args=(ranges,))
+        for tab_config, value_range in zip(sheet_config["tabs"], response["valueRanges"]):
+            # Pad the rows like get_all_values does, since the API trims trailing empty cells
+            sheet_data_frame = pd.DataFrame(fill_gaps(value_range.get("values", [])))
             sheet_data_frame.replace(anon_dict, inplace=True)
-            DATA_FRAME_INDEX_TO_NAME.append(data_frame_name)
             data_frames.append(sheet_data_frame)
-            index += 1
+            DATA_FRAME_INDEX_TO_NAME.append(tab_config["data_frame_name"])
 
     return data_frames
 
 
-def summarize_with_openai(summary_text: str, deanon_dict: dict = None) -> str:
-    """Summarizes text using the OpenAI GPT-4 model."""
-
+@functools.lru_cache(maxsize=None)
+def request_summary(summary_text: str, engineers_filter: str = "") -> str:
+    """
+    Requests a summary of the text from the OpenAI model. Responses are cached by prompt, so
+    identical prompts sent to several managers only cost one completion. The engineers filter is
+    sent as the last message, so the shared data frames stay a common prefix that OpenAI caches.
+    """
     openai.api_key = OPENAI_API_KEY
 
-    prompt_token_count = count_tokens(summary_text)
+    messages = [
+        {
+            "role": "system",
+            "content": (
+                "You are an analytics assistant. "
+                "Please analyze the data frames and provide insights based on the prompts. "
+                "You respond to answers in Slack bot mrkdwn formatting. "
+                "Make the summary as concise as possible. "
+            ),
+        },
+        {"role": "user", "content": summary_text},
+    ]
+    if engineers_filter:
+        messages.append({"role": "user", "content": engineers_filter})
+
+    response = backoff(
+        openai.ChatCompletion.create,
+        kwargs={
+            "model": MODEL,
+            "messages": messages,
+            "temperature": 0.01,
+            "max_tokens": MAX_TOKENS,
+        },
+        max_retries=6,
+        exceptions=openai.error.RateLimitError,
+    )
+
+    usage = response.get("usage", {})
+    cached_tokens = usage.get("prompt_tokens_details", {}).get("cached_tokens", 0)
+    print(f"Prompt tokens: {usage.get('prompt_tokens', 0)}, cached: {cached_tokens}")
+
+    return response.choices[0].message.content.strip()
+
+
+def summarize_with_openai(summary_text: str, deanon_dict: dict = None, engineers_filter: str = "") -> str:
+    """Summarizes text using the OpenAI model, optionally limited to the engineers in the filter."""
+    prompt_token_count = count_tokens(summary_text) + count_tokens(engineers_filter)
     if prompt_token_count > MAX_TOKENS:
         print(f"TOO MANY TOKENS: {prompt_token_count}")
         return "No summary generated."
 
-    response = openai.ChatCompletion.create(
-        model=MODEL,
-        messages=[
-            {
-                "role": "system",
-                "content": (
-                    "You are an analytics assistant. "
-                    "Please analyze the data frames and provide insights based on the prompts. "
-                    "You respond to answers in Slack bot mrkdwn formatting. "
-                    "Make the summary as concise as possible. "
-                ),
-            },
-            {"role": "user", "content": summary_text},
-        ],
-        temperature=0.01,
-        max_tokens=MAX_TOKENS,
-    )
-
-    summary = response.choices[0].message.content.strip()
+    summary = request_summary(summary_text, engineers_filter)
 
     if deanon_dict:
-        # De-anonymizing the response
-        for anon_name, original_name in deanon_dict.items():
-            summary = summary.replace(anon_name, original_name)
+        # De-anonymizing the response in a single pass, trying longer names first so that
+        # Anon10 is not read as Anon1
+        anon_names = sorted(deanon_dict, key=len, reverse=True)
+        pattern = re.compile("|".join(map(re.escape, anon_names)))
+        summary = pattern.sub(lambda match: deanon_dict[match.group(0)], summary)
 
     return summary if summary else "No summary generated."
 
@@ -249,12 +304,20 @@ def is_manager_opted_out(
     return False
 
 
+def wait_for_channel(channel: str):
+    """Sleeps until another message can be posted to the channel without being rate limited."""
+    last_message_time = LAST_MESSAGE_TIMES.get(channel)
+    if last_message_time is not None:
+        time.sleep(max(0.0, last_message_time + SLACK_MESSAGE_INTERVAL - time.monotonic()))
+    LAST_MESSAGE_TIMES[channel] = time.monotonic()
+
+
 def send_summary_to_slack(summary: str, user_id: str = ""):
     """Sends a summary to the specified user via Slack."""
-    client = WebClient(token=SLACK_TOKEN)
+    wait_for_channel(user_id)
 
     try:
-        client.chat_postMessage(channel=user_id, text=summary, mrkdwn=True)
+        SLACK_CLIENT.chat_postMessage(channel=user_id, text=summary, mrkdwn=True)
     except SlackApiError as error:
         print(f"Error sending message to {user_id}: {error}")
 
@@ -265,21 +328,31 @@ def generate_prompt_for_data_frames(
     relevant_data_frames: List[Dict[str, pd.DataFrame]],
     relevant_tabs: List[str],
     deanon_dict: Dict[str, str],
-    anon_to_manager_dict: Dict[str, str],
+    manager_to_anons: Dict[str, List[str]],
     limited_to_manager: bool = False,
-) -> str:
-    """Generates a prompt by incorporating relevant data frames."""
+) -> List[Tuple[str, str, str]]:
+    """
+    Generates a prompt by incorporating relevant data frames and summarizes it for each manager.
+    Returns the manager, their Slack user ID and their summary for each manager to notify.
+    """
     summary_prompt = f"{prompt}\n\n"
-    summary_text = summary_prompt
+    # Collect the prompt in parts and join them once, counting only the newly added tokens
+    summary_parts = [summary_prompt]
+    summary_token_count = count_tokens(summary_prompt)
 
     for index, data_frame in enumerate(relevant_data_frames):
         data_frame_name = relevant_tabs[index]  # Get the data frame name using the index
-        data_frame_text = data_frame.to_csv(index=False)
-        prompt_token_count = count_tokens(summary_text + data_frame_text)
+        data_frame_text = f"{data_frame_name}:\n{data_frame.to_csv(index=False)}\n\n"
+        prompt_token_count = summary_token_count + count_tokens(data_frame_text)
         if prompt_token_count > MAX_TOKENS:
             print(f"TOO MANY TOKENS: {prompt_token_count}")
             break
-        summary_text += f"{data_frame_name}:\n{data_frame_text}\n\n"
+        summary_parts.append(data_frame_text)
+        summary_token_count = prompt_token_count
+
+    summary_text = "".join(summary_parts)
+
+    summaries = []
 
     # Iterate over the report_to_manager_dict and append direct report information to the summary prompt
     for manager, user_id in MANAGERS.items():
@@ -287,16 +360,15 @@ def generate_prompt_for_data_frames(
             print(f"Skipping {manager}")
             continue
 
+        # Keep the data frames first and identical for every manager so the prompt prefix is cached
+        engineers_filter = ""
         if limited_to_manager:
-            direct_reports = [
-                anon_name
-                for anon_name, manager_name in anon_to_manager_dict.items()
-                if manager_name == manager
-            ]
-            summary_text = f"Only for these engineers: {direct_reports}\n\n" + summary_text
-        summary = summarize_with_openai(summary_text, deanon_dict)
-        print(f"Sending summary to {manager, user_id}")
-        send_summary_to_slack(summary, user_id)
+            direct_reports = manager_to_anons.get(manager, [])
+            engineers_filter = f"Only for these engineers: {direct_reports}"
+        summary = summarize_with_openai(summary_text, deanon_dict, engineers_filter)
+        summaries.append((manager, user_id, summary))
+
+    return summaries
 
 
 def main():
@@ -307,6 +379,11 @@ def main():
     )
     data_frames = get_google_sheets_data(GOOGLE_SHEETS_CONFIG, anon_dict)
 
+    # Index the direct reports of each manager once
+    manager_to_anons = defaultdict(list)
+    for anon_name, manager in anon_to_manager_dict.items():
+        manager_to_anons[manager].append(anon_name)
+
     prompt_data = [
         {
             "prompt": (
@@ -389,19 +466,26 @@ def main():
         },
     ]
 
-    for prompt_data_item in prompt_data:
-        prompt = prompt_data_item["prompt"]
-        relevant_tabs = prompt_data_item["relevant_tabs"]
-        limited_to_manager = prompt_data_item["limited_to_manager"]
-        relevant_data_frames = get_data_frames_for_prompt(data_frames, relevant_tabs)
-        generate_prompt_for_data_frames(
-            prompt,
-            relevant_data_frames,
-            relevant_tabs,
-            deanon_dict,
-            anon_to_manager_dict,
-            limited_to_manager,
-        )
+    # Summarize the prompts concurrently, since each one waits on a long completion, but send the
+    # summaries in the order of the prompts
+    with ThreadPoolExecutor(max_workers=OPENAI_MAX_WORKERS) as executor:
+        futures = [
+            executor.submit(
+                generate_prompt_for_data_frames,
+                prompt_data_item["prompt"],
+                get_data_frames_for_prompt(data_frames, prompt_data_item["relevant_tabs"]),
+                prompt_data_item["relevant_tabs"],
+                deanon_dict,
+                manager_to_anons,
+                prompt_data_item["limited_to_manager"],
+            )
+            for prompt_data_item in prompt_data
+        ]
+
+        for future in futures:
+            for manager, user_id, summary in future.result():
+                print(f"Sending summary to {manager, user_id}")
+                send_summary_to_slack(summary, user_id)
 
 
 if __name__ == "__main__":
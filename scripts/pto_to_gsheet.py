@@ -9,10 +9,14 @@ and then updates the Google Spreadsheet with the new data.
 
 import argparse
 import datetime
+import functools
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 
 import gspread
+import numpy as np
 import pandas as pd
 import utilities
 from google.oauth2 import service_account
@@ -29,6 +33,92 @@ PTO_SHEET_NAME = "PTO"
 ALIASES_SHEET_NAME = "Aliases"
 HOLIDAYS_SHEET_NAME = "Company Holidays"
 
+# Out of office event summaries look like "<Engineer> - Out of office"
+OUT_OF_OFFICE_PATTERN = re.compile(r"(.*) - Out of office", re.I)
+
+# Number of calendar lookups to run concurrently
+MAX_WORKERS = 4
+
+# Calendar services are not thread-safe, so each thread keeps its own
+calendar_services = threading.local()
+
+
+def get_calendar_service():
+    """
+    Authenticate with the Google Calendar API. The service is memoized per thread so the
+    authentication only happens once per thread, as the underlying connection cannot be shared.
+
+    :return: a Google Calendar API service
+    """
+    if not hasattr(calendar_services, "service"):
+        credentials = service_account.Credentials.from_service_account_file(
+            SERVICE_ACCOUNT_FILE, scopes=["https://www.googleapis.com/auth/calendar.readonly"]
+        )
+        calendar_services.service = build("calendar", "v3", credentials=credentials)
+    return calendar_services.service
+
+
+@functools.lru_cache(maxsize=1)
+def get_spreadsheet():
+    """
+    Authenticate with the Google Spreadsheet API and open the spreadsheet. The handle is memoized so
+    the authentication and lookup only happen once per run.
+
+    :return: the gspread.Spreadsheet
+    """
+    credentials = service_account.Credentials.from_service_account_file(
+        SERVICE_ACCOUNT_FILE, scopes=["https://www.googleapis.com/auth/spreadsheets"]
+    )
+    google = gspread.authorize(credentials)
+    return utilities.backoff(google.open_by_key, args=(SPREADSHEET_ID,))
+
+
+@functools.lru_cache(maxsize=None)
+def get_worksheet(sheet_name):
+    """
+    Get a worksheet of the spreadsheet. The handle is memoized per sheet name.
+
+    :param sheet_name: the name of the worksheet
+    :return: the gspread.Worksheet
+    """
+    return utilities.backoff(get_spreadsheet().worksheet, args=(sheet_name,))
+
+
+def get_calendar_events(calendar_id, start_date, end_date):
+    """
+    Fetch every event of a Google Calendar between two dates, following the pages of results.
+    Only the fields the script uses are requested.
+
+    :param calendar_id: the ID of the calendar
+    :param start_date: the start of the range as an RFC 3339 timestamp
+    :param end_date: the end of the range as an RFC 3339 timestamp
+    :return: a list of events with their summary, start and end
+    """
+    service = get_calendar_service()
+
+    events = []
+    page_token = None
+    while True:
+        events_result = utilities.backoff(
+            service.events()
+            .list(
+                calendarId=calendar_id,
+                timeMin=start_date,
+                timeMax=end_date,
+                singleEvents=True,
+                orderBy="startTime",
+                timeZone="UTC",
+                maxResults=2500,
+                pageToken=page_token,
+                fields="items(summary,start(date,dateTime),end(date,dateTime)),nextPageToken",
+            )
+            .execute
+        )
+        events.extend(events_result.get("items", []))
+        page_token = events_result.get("nextPageToken")
+        if not page_token:
+            return events
+
 
 def get_holiday_days(month):
     """
@@ -38,29 +128,10 @@ def get_holiday_days(month):
     :return: a dictionary mapping each holiday's name to its date in the specified month
     """
 
-    # Authenticate with Google Calendar API
-    credentials = service_account.Credentials.from_service_account_file(
-        SERVICE_ACCOUNT_FILE, scopes=["https://www.googleapis.com/auth/calendar.readonly"]
-    )
-    service = build("calendar", "v3", credentials=credentials)
-
     start_date, end_date = utilities.get_month_range(month, output_format="datetime")
     start_date = start_date.isoformat() + "Z"
     end_date = end_date.isoformat() + "Z"
-    events_result = (
-        service.events()
-        .list(
-            calendarId=HOLIDAYS_CALENDAR_ID,
-            timeMin=start_date,
-            timeMax=end_date,
-            singleEvents=True,
-            orderBy="startTime",
-            timeZone="UTC",
-        )
-        .execute()
-    )
-
-    events = utilities.backoff(events_result.get, args=("items", []))
+    events = get_calendar_events(HOLIDAYS_CALENDAR_ID, start_date, end_date)
 
     # Create a dictionary to store the holiday days
     holiday_days = {}
@@ -92,32 +163,12 @@ def get_out_of_office_days(month):
              specified month
     """
 
-    # Authenticate with Google Calendar API
-    credentials = service_account.Credentials.from_service_account_file(
-        SERVICE_ACCOUNT_FILE, scopes=["https://www.googleapis.com/auth/calendar.readonly"]
-    )
-    service = build("calendar", "v3", credentials=credentials)
-
     # Retrieve events from the specified calendar for the given month
 
     start_of_month, end_of_month = utilities.get_month_range(month, output_format="datetime")
     start_date = start_of_month.isoformat() + "Z"
     end_date = end_of_month.isoformat() + "Z"
-
-    events_result = (
-        service.events()
-        .list(
-            calendarId=CALENDAR_ID,
-            timeMin=start_date,
-            timeMax=end_date,
-            singleEvents=True,
-            orderBy="startTime",
-            timeZone="UTC",
-        )
-        .execute()
-    )
-
-    events = utilities.backoff(events_result.get, args=("items", []))
+    events = get_calendar_events(CALENDAR_ID, start_date, end_date)
 
     # Get the list of engineers from the "Aliases" sheet
     engineers = get_engineers_from_aliases_sheet()
@@ -125,6 +176,9 @@ def get_out_of_office_days(month):
     # Create a dictionary to store out of office days for each engineer, initialized with zeros
     out_of_office_days = {engineer: 0 for engineer in engineers}
 
+    # Look up engineers case-insensitively
+    engineers_by_name = {engineer.lower(): engineer for engineer in engineers}
+
     # Iterate over the events and count the out of office days for each engineer
     for event in events:
         start = event["start"].get("date") or event["start"].get("dateTime")
@@ -132,22 +186,19 @@ def get_out_of_office_days(month):
 
         # Check if the summary contains an engineer's name and 'out of office'
         if "summary" in event:
-            match = re.match(r"(.*) - Out of office", event["summary"], re.I)
+            match = OUT_OF_OFFICE_PATTERN.match(event["summary"])
             if match:
-                engineer = match.group(1)
-                if engineer.lower() in [e.lower() for e in engineers]:
+                engineer = engineers_by_name.get(match.group(1).lower())
+                if engineer is not None:
                     start_date = datetime.datetime.fromisoformat(start[:10])
                     end_date = datetime.datetime.fromisoformat(end[:10])
-                    days = 0
 
                     # Adjust start_date to the first day of the current month if the event
                     # starts before the current month
                     start_date = max(start_date, start_of_month)
 
-                    while start_date < end_date:
-                        if start_date.weekday() < 5:  # 0-4 denotes Monday to Friday
-                            days += 1
-                        start_date += timedelta(days=1)
+                    # Count the weekdays from start_date up to, but not including, end_date
+                    days = max(0, int(np.busday_count(start_date.date(), end_date.date())))
 
                     out_of_office_days[engineer] += days
     return out_of_office_days
@@ -159,13 +210,7 @@ def get_engineers_from_aliases_sheet():
 
     :return: a list of engineers' names
     """
-    # Authenticate with Google Spreadsheet API
-    credentials = service_account.Credentials.from_service_account_file(
-        SERVICE_ACCOUNT_FILE, scopes=["https://www.googleapis.com/auth/spreadsheets"]
-    )
-    google = gspread.authorize(credentials)
-    spreadsheet = google.open_by_key(SPREADSHEET_ID)
-    aliases_sheet = spreadsheet.worksheet(ALIASES_SHEET_NAME)
+    aliases_sheet = get_worksheet(ALIASES_SHEET_NAME)
 
     # Read the engineers' names from the "Aliases" sheet
     data = aliases_sheet.get_all_values()
@@ -191,24 +236,23 @@ def update_holidays_sheet(month, holiday_days):
     # Convert 'YYYY-MM' to 'Month YYYY'
     month_str = datetime.datetime.strptime(month, "%Y-%m").strftime("%B %Y")
 
-    # Authenticate with Google Spreadsheet API
-    credentials = service_account.Credentials.from_service_account_file(
-        SERVICE_ACCOUNT_FILE, scopes=["https://www.googleapis.com/auth/spreadsheets"]
-    )
-    google = gspread.authorize(credentials)
-    spreadsheet = google.open_by_key(SPREADSHEET_ID)
-    holidays_sheet = spreadsheet.worksheet(HOLIDAYS_SHEET_NAME)
+    holidays_sheet = get_worksheet(HOLIDAYS_SHEET_NAME)
 
     # Read existing data from the Holiday sheet
     data = holidays_sheet.get_all_values()
     headers = data[0]
 
+    # Collect every cell to write so they can be sent in a single request
+    cells = []
+
     # Check if month_str already exists in the headers
     if month_str not in headers:
         # Insert a new column to the right of the last month
         holidays_sheet.insert_cols(len(headers) + 1)  # 1-indexed
-        holidays_sheet.update_cell(1, len(headers) + 1, month_str)
+        cells.append(gspread.Cell(1, len(headers) + 1, month_str))
         headers.append(month_str)
+        for row in data[1:]:
+            row.append("")
 
     # Create a new DataFrame with the updated out of office days
     dataframe = pd.DataFrame(data[1:], columns=headers)
@@ -221,7 +265,12 @@ def update_holidays_sheet(month, holiday_days):
             # idx is zero-based so adding 2 will start it from 2 (as in spreadsheet)
             cell_row = idx + 2
             cell_col = headers.index(month_str) + 1
-            utilities.backoff(holidays_sheet.update_cell, args=(cell_row, cell_col, cell_value))
+            cells.append(gspread.Cell(cell_row, cell_col, cell_value))
+
+    if cells:
+        utilities.backoff(
+            holidays_sheet.update_cells, args=(cells,), kwargs={"value_input_option": "USER_ENTERED"}
+        )
 
     print(f"Updated the Google Spreadsheet with US holidays for {month}.")
 
@@ -238,49 +287,45 @@ def update_pto_sheet(month, out_of_office_days):
     # Convert 'YYYY-MM' to 'Month YYYY'
     month_str = datetime.datetime.strptime(month, "%Y-%m").strftime("%B %Y")
 
-    # Authenticate with Google Spreadsheet API
-    credentials = service_account.Credentials.from_service_account_file(
-        SERVICE_ACCOUNT_FILE, scopes=["https://www.googleapis.com/auth/spreadsheets"]
-    )
-    google = gspread.authorize(credentials)
-    spreadsheet = google.open_by_key(SPREADSHEET_ID)
-    pto_sheet = spreadsheet.worksheet(PTO_SHEET_NAME)
+    pto_sheet = get_worksheet(PTO_SHEET_NAME)
 
     # Read existing data from the PTO sheet
     data = pto_sheet.get_all_values()
     headers = data[0]
 
+    # Collect every cell to write so they can be sent in a single request
+    cells = []
+
     # Check if month_str already exists in the headers
     if month_str not in headers:
         # Insert a new column to the right of 'Engineer - IC'
         engineer_ic_index = headers.index("Engineer - IC")
         pto_sheet.insert_cols(engineer_ic_index + 2)  # 1-indexed
-        pto_sheet.update_cell(1, engineer_ic_index + 2, month_str)
+        cells.append(gspread.Cell(1, engineer_ic_index + 2, month_str))
         headers.insert(engineer_ic_index + 1, month_str)
+        for row in data[1:]:
+            row.insert(engineer_ic_index + 1, "")
 
-    # Create a new DataFrame with the updated out of office days
+    # Create a new DataFrame with the updated out of office days, matching engineers case-insensitively
     dataframe = pd.DataFrame(data[1:], columns=headers)
-    for engineer, days in out_of_office_days.items():
-        dataframe.loc[dataframe["Engineer - IC"].str.lower() == engineer.lower(), month_str] = days
+    engineer_names = dataframe["Engineer - IC"].str.lower()
+    days_by_name = {engineer.lower(): days for engineer, days in out_of_office_days.items()}
 
-    # Replace NaNs with zero
-    dataframe = dataframe.fillna(0)
-
-    # Enforce the column to be of integer type
+    # Enforce the column to be of integer type, with zero for engineers without any days
     # pylint: disable-next=unsupported-assignment-operation,unsubscriptable-object
-    dataframe[month_str] = dataframe[month_str].astype(int)
-
-    for engineer, days in out_of_office_days.items():
-        # pylint: disable-next=unsupported-assignment-operation,unsubscriptable-object
-        mask = dataframe["Engineer - IC"].str.lower() == engineer.lower()
-        # pylint: disable-next=unsupported-assignment-operation,unsubscriptable-object
-        dataframe.loc[mask, month_str] = days
-
-        for idx, _ in dataframe.loc[mask].iterrows():
-            cell_value = days
-            cell_row = idx + 2  # Convert the index to start from 2 (for spreadsheet indexing)
-            cell_col = headers.index(month_str) + 1
-            utilities.backoff(pto_sheet.update_cell, args=(cell_row, cell_col, cell_value))
+    dataframe[month_str] = engineer_names.map(days_by_name).fillna(0).astype(int)
+
+    mask = engineer_names.isin(days_by_name)
+    cell_col = headers.index(month_str) + 1
+    # pylint: disable-next=unsubscriptable-object
+    for idx, cell_value in zip(dataframe.index[mask], dataframe.loc[mask, month_str].tolist()):
+        cell_row = idx + 2  # Convert the index to start from 2 (for spreadsheet indexing)
+        cells.append(gspread.Cell(cell_row, cell_col, cell_value))
+
+    if cells:
+        utilities.backoff(
+            pto_sheet.update_cells, args=(cells,), kwargs={"value_input_option": "USER_ENTERED"}
+        )
 
     print(f"Updated the Google Spreadsheet with out of office days for {month}.")
 
@@ -306,18 +351,29 @@ def main():
     argparser = get_argument_parser()
     args = argparser.parse_args()
 
-    for arg_month in args.months:
-        print(f"Processing month: {arg_month}")
-
-        out_of_offices = get_out_of_office_days(arg_month)
-        print(f"Out of Office Days: {out_of_offices}")
-        update_pto_sheet(arg_month, out_of_offices)
-
-        holiday_days = get_holiday_days(arg_month)
-        print(f"Holiday Days: {holiday_days}")
-        update_holidays_sheet(arg_month, holiday_days)
-
-        print(f"Completed processing month: {arg_month}")
+    # Fetch the calendars of every month concurrently, then update the sheets one month at a time
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [
+            (
+                arg_month,
+                executor.submit(get_out_of_office_days, arg_month),
+                executor.submit(get_holiday_days, arg_month),
+            )
+            for arg_month in args.months
+        ]
+
+        for arg_month, out_of_offices_future, holiday_days_future in futures:
+            print(f"Processing month: {arg_month}")
+
+            out_of_offices = out_of_offices_future.result()
+            print(f"Out of Office Days: {out_of_offices}")
+            update_pto_sheet(arg_month, out_of_offices)
+
+            holiday_days = holiday_days_future.result()
+            print(f"Holiday Days: {holiday_days}")
+            update_holidays_sheet(arg_month, holiday_days)
+
+            print(f"Completed processing month: {arg_month}")
 
 
 # Main script execution
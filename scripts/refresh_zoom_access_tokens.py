@@ -5,8 +5,8 @@
 
 import os
 
-import requests
 from dotenv import load_dotenv, set_key
+from utilities import create_session
 
 # Load environment variables from .env file
 load_dotenv()
@@ -17,33 +17,39 @@ refresh_token = os.getenv("ZOOM_REFRESH_TOKEN")
 client_id = os.getenv("ZOOM_CLIENT_ID")
 client_secret = os.getenv("ZOOM_CLIENT_SECRET")
 
+# Zoom OAuth token endpoint
+URL = "https://zoom.us/oauth/token"
+
+# Shared session so repeated refreshes reuse the connection. A refresh token can only be used once, so
+# the POST is never retried in case the server used it before failing
+SESSION = create_session(allowed_methods=("GET",))
+
 
 def refresh_access_tokens():
     """
     Refresh the Zoom access token.
     """
-    # Define the endpoint for token refresh
-    refresh_url = (
-        f"https://zoom.us/oauth/token?grant_type=refresh_token"
-        f"&refresh_token={refresh_token}"
-        f"&client_id={client_id}"
-        f"&client_secret={client_secret}"
+    # Make a POST request to refresh the access token, sending the secrets in the body and
+    # Basic auth header rather than in the URL
+    response = SESSION.post(
+        URL,
+        data={"grant_type": "refresh_token", "refresh_token": refresh_token},
+        auth=(client_id, client_secret),
+        timeout=10,
     )
-
-    # Make a POST request to refresh the access token
-    response = requests.post(refresh_url, timeout=10)
+    json_response = response.json()
 
     # Check if the request was successful
     if response.status_code == 200:
         # Update the access token with the new value
-        new_access_token = response.json()["access_token"]
-        new_refresh_token = response.json()["refresh_token"]
+        new_access_token = json_response["access_token"]
+        new_refresh_token = json_response["refresh_token"]
         set_key(".env", "ZOOM_ACCESS_TOKEN", new_access_token)
         set_key(".env", "ZOOM_REFRESH_TOKEN", new_refresh_token)
         print("Access token refreshed successfully!")
         return new_access_token, new_refresh_token
     print("Failed to refresh access token. Status code:", response.status_code)
-    print("Response:", response.json())
+    print("Response:", json_response)
     return None, None
 
 
@@ -11,21 +11,24 @@ Refer to the project's README for setup prerequisites and usage instructions.
 
 import argparse
 import functools
+import itertools
 import json
 import os
+import random
 import re
 import time
 from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import gspread
+import orjson
 import pandas as pd
 import requests
 from dateutil.relativedelta import relativedelta
 from dotenv import load_dotenv
 from gspread_dataframe import set_with_dataframe
-from oauth2client.service_account import ServiceAccountCredentials
-from utilities import get_month_range
+from utilities import create_session, disk_cache, get_month_range
 
 # Load environment variables
 load_dotenv()
@@ -34,15 +37,27 @@ API_TOKEN = os.getenv("SEMAPHORECI_API_TOKEN")
 ORG_NAME = os.getenv("SEMAPHORECI_ORG_NAME")
 HEADERS = {
     "Authorization": f"Token {API_TOKEN}",
+    "Accept": "application/json",
+    "Accept-Encoding": "gzip, deflate",
 }
 
 
 BASE_URL = f"https://{ORG_NAME}.semaphoreci.com/api/v1alpha"
 
+# Matches the URL of the next page in a 'link' header
+NEXT_LINK_PATTERN = re.compile(r'<([^>]+)>;\s*rel="next"')
+
 
 # Google Sheets details
 GSHEET_ID = "1DQKeS1XsYytlQFFmCCUBOo_CGznCBJ6QVcdh6NqtOJA"
 
+# Number of requests to make to Semaphore CI concurrently
+MAX_WORKERS = 16
+
+# Keep the connections to Semaphore CI alive between requests. Rate limited requests are retried by
+# get_with_retry, so the session only retries server errors
+SESSION = create_session(pool_maxsize=MAX_WORKERS, headers=HEADERS, retry_rate_limited=False)
+
 
 class ApiError(Exception):
     """An exception that represents an API error."""
@@ -64,7 +79,7 @@ def handle_api_errors(func):
     A decorator to handle API errors.
 
     This decorator catches requests exceptions and JSON decoding errors, and prints an error
-    message.
+    message. orjson decoding errors are JSON decoding errors too.
 
     Args:
         func (callable): The function to decorate.
@@ -84,30 +99,38 @@ def handle_api_errors(func):
     return wrapper
 
 
-def handle_rate_limiting(response):
+def get_with_retry(url, params=None, max_retries=15):
     """
-    Handle rate limiting by checking the response status code and headers.
+    Make a GET request, retrying while it is rate limited.
 
     If the status code is 429 (Too Many Requests), the function will pause
-    the execution for a certain amount of time before making the next request.
+    the execution for a certain amount of time before retrying the request.
     The amount of time to pause is determined by the 'Retry-After' header in
     the response, if it is present. If the 'Retry-After' header is not present,
-    the function will pause for 1 second by default.
+    the pause grows exponentially with each retry, plus a random jitter. Pauses
+    are capped at one minute.
 
     Args:
-        response (requests.Response): The response object to check.
+        url (str): The URL to request.
+        params (dict, optional): The query parameters to send with the request.
+        max_retries (int): The maximum number of times to make the request. Default is 15.
 
     Returns:
-        bool: True if the response status code is 429, False otherwise.
+        requests.Response: The first response that is not rate limited.
+
+    Raises:
+        requests.exceptions.HTTPError: If the request is still rate limited after the last retry.
     """
-    if response.status_code == 429:
+    for retry_count in range(max_retries):
+        response = SESSION.get(url, params=params, timeout=60)
+        if response.status_code != 429:
+            break
         retry_after = response.headers.get("Retry-After")
-        if retry_after:
-            time.sleep(int(retry_after))
-        else:
-            time.sleep(1)
-        return True
-    return False
+        sleep_time = int(retry_after) if retry_after else (2**retry_count) + random.uniform(0, 1)
+        time.sleep(min(sleep_time, 60))
+    else:
+        response.raise_for_status()
+    return response
 
 
 def valid_date(date_string):
@@ -143,16 +166,14 @@ def get_projects():
         ApiError: If the API returns an error status code.
     """
     projects_url = f"{BASE_URL}/projects"
-    projects_response = requests.get(projects_url, headers=HEADERS, timeout=60)
+    projects_response = get_with_retry(projects_url)
     if projects_response.status_code != 200:
         raise ApiError(f"Error getting projects: {projects_response.text}")
-    if handle_rate_limiting(projects_response):
-        return get_projects()
-    return projects_response.json()
+    return orjson.loads(projects_response.content)
 
 
 @handle_api_errors
-def get_pipelines(project_id, month=None, main_branch_only=False):
+def get_pipelines(project_id, start_of_month, end_of_month, main_branch_only=False):
     """
     Retrieve all pipelines for a given project.
 
@@ -166,40 +187,37 @@ def get_pipelines(project_id, month=None, main_branch_only=False):
 
     Args:
         project_id (str): The ID of the project to retrieve pipelines for.
+        start_of_month (int): The timestamp to retrieve pipelines created after.
+        end_of_month (int): The timestamp to retrieve pipelines created before.
         main_branch_only (bool): Whether to retrieve pipelines only for the "main" branch.
             Default is False.
 
     Returns:
         list: A list of pipelines for the project.
     """
-    start_of_month, end_of_month = get_month_range(month)
-
-    pipelines_url = (
-        f"{BASE_URL}/pipelines"
-        f"?project_id={project_id}"
-        f"&created_after={start_of_month}"
-        f"&created_before={end_of_month}"
-    )
-
+    pipelines_url = f"{BASE_URL}/pipelines"
+    params = {
+        "project_id": project_id,
+        "created_after": start_of_month,
+        "created_before": end_of_month,
+    }
     if main_branch_only:
-        pipelines_url += "&branch=main"
+        params["branch"] = "main"
+
     pipelines = []
     while True:
-        pipelines_response = requests.get(pipelines_url, headers=HEADERS, timeout=60)
-        if handle_rate_limiting(pipelines_response):
-            continue
-        pipelines_data = pipelines_response.json()
+        pipelines_response = get_with_retry(pipelines_url, params)
+        pipelines_data = orjson.loads(pipelines_response.content)
         pipelines.extend(pipelines_data)
         link_header = pipelines_response.headers.get("link")
-        if link_header is not None:
-            pattern = r'<(.+?)>; rel="next"'
-            matches = re.findall(pattern, link_header)
-            if matches:
-                pipelines_url = matches[0]
-            else:
-                break
-        else:
+        if link_header is None:
+            break
+        match = NEXT_LINK_PATTERN.search(link_header)
+        if not match:
             break
+        # The next page URL already includes the query parameters
+        pipelines_url = match.group(1)
+        params = None
     return pipelines
 
 
@@ -220,40 +238,125 @@ def get_pipeline_details(pipeline_id):
         dict: A dictionary containing the details of the pipeline.
     """
     pipeline_url = f"{BASE_URL}/pipelines/{pipeline_id}?detailed=true"
-    pipeline_response = requests.get(pipeline_url, headers=HEADERS, timeout=60)
-    if handle_rate_limiting(pipeline_response):
-        return get_pipeline_details(pipeline_id)
-    return pipeline_response.json()
+    pipeline_response = get_with_retry(pipeline_url)
+    return orjson.loads(pipeline_response.content)
+
+
+def get_cached_pipeline_details(pipeline):
+    """
+    Retrieve the details of a pipeline, caching them on disk once the pipeline is done.
+
+    Finished pipelines never change, so their details are only fetched once across runs.
+    Pipelines that are still running are always fetched.
+
+    Args:
+        pipeline (dict): The pipeline to retrieve details for.
+
+    Returns:
+        dict: A dictionary containing the details of the pipeline.
+    """
+    if pipeline.get("state", "").lower() != "done":
+        return get_pipeline_details(pipeline["ppl_id"])
+
+    return disk_cache(
+        "semaphoreci_pipelines", pipeline["ppl_id"], get_pipeline_details, args=(pipeline["ppl_id"],)
+    )
 
 
-def process_pipeline(pipeline, project_name, counter):
+def process_pipeline(pipeline, detailed=False):
     """
-    Process a pipeline and update the counter.
+    Retrieve the details of a pipeline and count its results.
+
+    Every pipeline is counted once from its listed result without retrieving its details, unless
+    detailed is set, in which case the jobs of every pipeline with several blocks are counted instead.
+    Either way, passed and failed results are counted in the same unit.
 
     Args:
         pipeline (dict): The pipeline to process.
-        project_name (str): The name of the project the pipeline belongs to.
-        counter (collections.defaultdict): The counter for project statuses.
+        detailed (bool): Whether to count the blocks and jobs of pipelines. Default is False.
+
+    Returns:
+        collections.Counter: The number of times each result occurred in the pipeline.
     """
-    pipeline_details = get_pipeline_details(pipeline["ppl_id"])
+    results = Counter()
+    if not detailed:
+        results[pipeline["result"].lower()] += 1
+        return results
+
+    pipeline_details = get_cached_pipeline_details(pipeline)
 
     if not pipeline_details:
-        counter[project_name][pipeline["result"].lower()] += 1
-        return
+        results[pipeline["result"].lower()] += 1
+        return results
 
     if "blocks" in pipeline_details and len(pipeline_details["blocks"]) > 1:
-        for block in pipeline_details["blocks"]:
-            jobs = block.get("jobs", [])
-            results = [job["result"].lower() for job in jobs] if jobs else [block["result"].lower()]
-            for result in results:
-                counter[project_name][result] += 1
+        # Count every job's result, or the block's result if it has no jobs, in a single update
+        results.update(
+            itertools.chain.from_iterable(
+                (job["result"].lower() for job in block.get("jobs") or [block])
+                for block in pipeline_details["blocks"]
+            )
+        )
     elif "pipeline" in pipeline_details and "result" in pipeline_details["pipeline"]:
-        counter[project_name][pipeline_details["pipeline"]["result"].lower()] += 1
+        results[pipeline_details["pipeline"]["result"].lower()] += 1
     else:
-        counter[project_name][pipeline["result"].lower()] += 1
+        results[pipeline["result"].lower()] += 1
+
+    return results
+
+
+def submit_pipeline_listings(executor, projects, month, main_branch_only=False):
+    """
+    Request the pipelines of every project up front so the listings are fetched concurrently.
 
+    Args:
+        executor (concurrent.futures.Executor): The executor to fetch the listings with.
+        projects (list): The projects to retrieve pipelines for.
+        month (datetime.date, optional): The month to retrieve pipelines for.
+        main_branch_only (bool): Whether to retrieve pipelines only for the "main" branch.
+            Default is False.
 
-def get_project_metrics(csv=False, main_branch_only=False, month=None):
+    Returns:
+        list: Tuples of the name of each project and the future of its pipelines.
+    """
+    start_of_month, end_of_month = get_month_range(month)
+    pipelines_futures = []
+    for project in projects:
+        if "id" not in project["metadata"]:
+            print(f"No 'id' key in project: {project}")
+            continue
+        project_id = project["metadata"]["id"]
+        project_name = project["metadata"]["name"]
+        future = executor.submit(get_pipelines, project_id, start_of_month, end_of_month, main_branch_only)
+        pipelines_futures.append((project_name, future))
+    return pipelines_futures
+
+
+def count_project_results(executor, project_name, pipelines, project_counter, detailed=False):
+    """
+    Process the pipelines of a project concurrently and merge their counts.
+
+    Args:
+        executor (concurrent.futures.Executor): The executor to process the pipelines with.
+        project_name (str): The name of the project the pipelines belong to.
+        pipelines (list): The pipelines of the project.
+        project_counter (collections.Counter): The counts of the project, updated in place.
+        detailed (bool): Whether to count the blocks and jobs of pipelines instead of the pipelines.
+            Default is False.
+    """
+    for results in executor.map(functools.partial(process_pipeline, detailed=detailed), pipelines):
+        project_counter.update(results)
+
+    # Check if the total count of results is less than the number of pipelines
+    total_results = sum(project_counter.values())
+    if total_results < len(pipelines):
+        print(
+            f"Warning: Total result count ({total_results}) for project {project_name} "
+            f"is less than the number of pipelines ({len(pipelines)})"
+        )
+
+
+def get_project_metrics(csv=False, main_branch_only=False, month=None, detailed=False, gzip=False):
     """
     Retrieve failure details for all projects and write them to a CSV file.
 
@@ -266,36 +369,27 @@ def get_project_metrics(csv=False, main_branch_only=False, month=None):
             Default is False.
         month (datetime.date, optional): The month to retrieve pipelines for.
             If None, pipelines for the last month will be retrieved. Defaults to None.
+        detailed (bool): Whether to count the blocks and jobs of pipelines instead of the pipelines.
+            Default is False.
+        gzip (bool): Whether to compress the CSV file with gzip. Default is False.
     """
-    projects = get_projects()
-    counter = defaultdict(Counter)
-
-    for project in projects:
-        if "id" not in project["metadata"]:
-            print(f"No 'id' key in project: {project}")
-            continue
-        project_id = project["metadata"]["id"]
-        project_name = project["metadata"]["name"]
-        pipelines = get_pipelines(project_id, month, main_branch_only)
-        print(f"Found {len(pipelines)} pipelines for project {project_name}")
-        if not pipelines:
-            counter[project_name]["passed"] = 0
-            counter[project_name]["failed"] = 0
-            continue
-        for pipeline in pipelines:
-            process_pipeline(pipeline, project_name, counter)
-
-        # Check if the total count of results is less than the number of pipelines
-        total_results = sum(counter[project_name].values())
-        if total_results < len(pipelines):
-            print(
-                f"Warning: Total result count ({total_results}) for project {project_name} "
-                f"is less than the number of pipelines ({len(pipelines)})"
-            )
+    projects = get_projects() or []
+    # Every project reports passed and failed, even if it had no pipelines
+    counter = defaultdict(lambda: Counter({"passed": 0, "failed": 0}))
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        for project_name, future in submit_pipeline_listings(executor, projects, month, main_branch_only):
+            # Pipelines that could not be retrieved are reported as None
+            pipelines = future.result() or []
+            print(f"Found {len(pipelines)} pipelines for project {project_name}")
+            # Looking the project up adds it with the default counts, even if it has no pipelines
+            project_counter = counter[project_name]
+            if pipelines:
+                count_project_results(executor, project_name, pipelines, project_counter, detailed)
 
     dataframe = counter_to_dataframe(counter)
     if csv:
-        write_to_csv(dataframe, month, main_branch_only)
+        write_to_csv(dataframe, month, main_branch_only, gzip)
     else:
         write_to_gsheet(dataframe, month)
 
@@ -311,33 +405,45 @@ def counter_to_dataframe(counter):
     Returns:
         dataframe (pandas.DataFrame): A DataFrame representation of the counter.
     """
-    # Identify all unique result names across all projects
-    result_names = set()
-    for project_counter in counter.values():
-        result_names.update(project_counter.keys())
-
-    data = {"Project Name": list(counter.keys())}
-
-    # Add a column for each result name
-    for result_name in result_names:
-        data[result_name] = [project_counter.get(result_name, 0) for project_counter in counter.values()]
-
-    dataframe = pd.DataFrame(data)
-    return dataframe
+    # Build a row per project, with a column for each result name found in any project
+    dataframe = pd.DataFrame.from_dict(counter, orient="index")
+    dataframe = dataframe.fillna(0).astype(int)
+    dataframe.index.name = "Project Name"
+    return dataframe.reset_index()
 
 
-def write_to_csv(dataframe, month, main_branch_only=True):
+def write_to_csv(dataframe, month, main_branch_only=True, gzip=False):
     """
     Write the DataFrame to a CSV file.
 
     Args:
         dataframe (pandas.DataFrame): The DataFrame to write to a CSV file.
         month (str): The month, in the format "YYYY-MM".
+        gzip (bool): Whether to compress the file with gzip, adding ".gz" to its name. Default is False.
     """
     filename = f"{month}_semaphoreci_build_metrics.csv"
     if main_branch_only:
         filename = f"{month}_semaphoreci_build_metrics_main_branch.csv"
-    dataframe.to_csv(filename, index=False)
+    if gzip:
+        dataframe.to_csv(f"{filename}.gz", index=False, compression="gzip")
+    else:
+        dataframe.to_csv(filename, index=False)
+
+
+@functools.lru_cache(maxsize=1)
+def get_spreadsheet():
+    """
+    Authorizes with Google Sheets and opens the spreadsheet. The handle is memoized so the
+    authorization and lookup only happen once per run.
+
+    Returns:
+        gspread.Spreadsheet: The spreadsheet.
+    """
+    google = gspread.service_account(
+        filename="google-credentials.json",
+        scopes=["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"],
+    )
+    return google.open_by_key(GSHEET_ID)
 
 
 def write_to_gsheet(dataframe, month):
@@ -348,23 +454,16 @@ def write_to_gsheet(dataframe, month):
         dataframe (pandas.DataFrame): The DataFrame to write to a Google Spreadsheet.
         month (str): The month, in the format "YYYY-MM".
     """
-
-    # Setup authentication
-    credentials = ServiceAccountCredentials.from_json_keyfile_name(
-        "google-credentials.json",
-        ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"],
-    )
-
-    # Access the Google Spreadsheet
-    google = gspread.authorize(credentials)
-    spreadsheet = google.open_by_key(GSHEET_ID)
+    spreadsheet = get_spreadsheet()
 
     # Try to select the sheet with the name of the month
-    # If it doesn't exist, create it
+    # If it doesn't exist, create it large enough for the dataframe so it doesn't need resizing
     try:
         worksheet = spreadsheet.worksheet(month)
     except gspread.exceptions.WorksheetNotFound:
-        worksheet = spreadsheet.add_worksheet(title=month, rows="100", cols="20")
+        worksheet = spreadsheet.add_worksheet(
+            title=month, rows=len(dataframe) + 10, cols=len(dataframe.columns) + 2
+        )
 
     # Write the dataframe to the sheet
     set_with_dataframe(worksheet, dataframe, include_column_header=True)
@@ -404,13 +503,33 @@ def main():
         help="Write results to CSV. Default is False and writes to GSheet.",
     )
 
+    parser.add_argument(
+        "--gzip",
+        action="store_true",
+        default=False,
+        help="Compress the CSV with gzip. Only used with --csv. Default is False.",
+    )
+
+    parser.add_argument(
+        "--detailed",
+        action="store_true",
+        default=False,
+        help="Count the blocks and jobs of pipelines instead of the pipelines. Default is False.",
+    )
+
     args = parser.parse_args()
 
     # Check API token
     check_api_token()
 
     # Get project metrics
-    get_project_metrics(csv=args.csv, main_branch_only=args.main_branch_only, month=args.month)
+    get_project_metrics(
+        csv=args.csv,
+        main_branch_only=args.main_branch_only,
+        month=args.month,
+        detailed=args.detailed,
+        gzip=args.gzip,
+    )
 
 
 if __name__ == "__main__":
@@ -2,11 +2,25 @@
 # pylint: disable=broad-exception-caught,inconsistent-return-statements,too-many-arguments
 
 import calendar
+import functools
+import math
+import os
 import random
-import re
+import shelve
+import threading
 import time
 from datetime import datetime, timedelta
 
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Directory for caches that persist between runs.
+CACHE_DIRECTORY = ".cache"
+
+# shelve files must not be opened by several threads at once.
+_disk_cache_lock = threading.Lock()
+
 
 def get_previous_month():
     """
@@ -16,6 +30,23 @@ def get_previous_month():
     return last_month.strftime("%Y-%m")
 
 
+def get_retry_after(error):
+    """
+    Get the number of seconds a server asked to wait before retrying a failed request.
+
+    :param error: The exception raised by the request, such as a requests.HTTPError, gspread.APIError
+                  or openai.error.RateLimitError.
+    :return: The number of seconds from the Retry-After header, or None if there is none.
+    """
+    # OpenAI errors carry the response headers themselves rather than the response
+    headers = getattr(getattr(error, "response", None), "headers", None) or getattr(error, "headers", None)
+    retry_after = (headers or {}).get("Retry-After")
+    try:
+        return max(float(retry_after), 0)
+    except (TypeError, ValueError):
+        return None
+
+
 def backoff(function, args=None, kwargs=None, sleep_time=1, max_retries=15, exceptions=Exception):
     """
     Call a function with exponential backoff.
@@ -23,7 +54,9 @@ def backoff(function, args=None, kwargs=None, sleep_time=1, max_retries=15, exce
     This function attempts to call the provided function with the given arguments.
     If the function raises an exception, this function sleeps for an exponentially
     increasing amount of time (plus a random jitter) and then tries again, up to a
-    maximum number of retries.
+    maximum number of retries. When the exception carries an HTTP response with a
+    Retry-After header, such as a rate-limited Zoom or Google Sheets request, the
+    function sleeps for as long as the server asks instead.
 
     :param function: The function to call.
     :param args: A tuple of arguments to pass to the function.
@@ -41,11 +74,116 @@ def backoff(function, args=None, kwargs=None, sleep_time=1, max_retries=15, exce
         except exceptions as error:
             if retry_count >= max_retries - 1:
                 raise
-            backoff_time = ((2**retry_count) * sleep_time) + random.uniform(0, 1)
+            backoff_time = get_retry_after(error)
+            if backoff_time is None:
+                backoff_time = ((2**retry_count) * sleep_time) + random.uniform(0, 1)
             print(f"Encountered an error: {error}. Retrying in {backoff_time} seconds...")
             time.sleep(backoff_time)
 
 
+def create_session(
+    pool_maxsize=10,
+    auth=None,
+    headers=None,
+    *,
+    retry_rate_limited=True,
+    allowed_methods=("GET", "POST"),
+    raise_on_status=True,
+):
+    """
+    Create a requests session that keeps connections alive between calls and retries
+    rate-limited and failed requests, honoring the Retry-After header on 429s.
+
+    :param pool_maxsize: The maximum number of connections to keep open per host.
+    :param auth: Optional authentication to use for every request.
+    :param headers: Optional headers to send with every request.
+    :param retry_rate_limited: Whether to retry 429 responses. Set to False to return them,
+                               so the caller can handle rate limiting itself.
+    :param allowed_methods: The HTTP methods to retry. Leave out POST for requests that must
+                            not be sent twice, such as redeeming a one-time grant.
+    :param raise_on_status: Whether to raise a RetryError when a request still fails after the
+                            last retry. Set to False to return the last response instead.
+    :return: The session.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_maxsize,
+        pool_maxsize=pool_maxsize,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=1,
+            status_forcelist=[429, 500, 502, 503, 504] if retry_rate_limited else [500, 502, 503, 504],
+            # urllib3 retries responses with a Retry-After header even if their status is not listed
+            respect_retry_after_header=retry_rate_limited,
+            allowed_methods=allowed_methods,
+            raise_on_status=raise_on_status,
+        ),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.auth = auth
+    if headers:
+        session.headers.update(headers)
+    return session
+
+
+def disk_cache(cache_name, key, function, args=None, kwargs=None):
+    """
+    Return a value from a cache on disk, calling the function to compute and store it if missing.
+
+    The cache is a `shelve` file in the `.cache` directory, so it persists between runs. Only use
+    it for values that never change once computed. None is not stored, so failed calls are retried.
+
+    :param cache_name: The name of the cache file.
+    :param key: A string uniquely identifying the value.
+    :param function: The function to call if the value is not cached.
+    :param args: A tuple of arguments to pass to the function.
+    :param kwargs: A dictionary of keyword arguments to pass to the function.
+    :return: The cached or computed value.
+    """
+    args = args or ()
+    kwargs = kwargs or {}
+    os.makedirs(CACHE_DIRECTORY, exist_ok=True)
+    path = os.path.join(CACHE_DIRECTORY, cache_name)
+
+    with _disk_cache_lock, shelve.open(path) as cache:
+        if key in cache:
+            return cache[key]
+
+    value = function(*args, **kwargs)
+    if value is None:
+        return value
+
+    with _disk_cache_lock, shelve.open(path) as cache:
+        cache[key] = value
+
+    return value
+
+
+def is_cell_unchanged(data, row, column, value):
+    """
+    Check whether a cell read from a sheet already holds the given value, so writing it again can
+    be skipped. Read the sheet with the UNFORMATTED_VALUE render option, since a formatted cell may
+    be displayed rounded. Numbers are compared numerically, in case they are returned as text.
+
+    :param data: The values read from the sheet, as a list of rows.
+    :param row: The 1-based row of the cell.
+    :param column: The 1-based column of the cell.
+    :param value: The value about to be written to the cell.
+    :return: True if the cell already holds the value, False otherwise.
+    """
+    try:
+        existing_value = data[row - 1][column - 1]
+    except IndexError:
+        return False
+
+    try:
+        return math.isclose(float(str(existing_value).replace(",", "")), float(value))
+    except (TypeError, ValueError):
+        return str(existing_value) == str(value)
+
+
+@functools.lru_cache(maxsize=64)
 def get_month_range(date_input=None, output_format="timestamp"):
     """
     Calculate the first and last second of the given month, or the previous month if None.
@@ -60,7 +198,7 @@ def get_month_range(date_input=None, output_format="timestamp"):
 
     Returns:
         tuple: The start and end of the month in the desired format. The end will be inclusive of the last
-               second of the last day if `output_format` is 'timestamp'.
+               second of the last day if `output_format` is 'timestamp'. Timestamps are in UTC.
     """
     if date_input is None:
         date_input = get_previous_month()
@@ -82,10 +220,10 @@ def get_month_range(date_input=None, output_format="timestamp"):
     last_day_of_month = datetime(year, month, calendar.monthrange(year, month)[1])
 
     if output_format == "timestamp":
-        first_day_of_month = first_day_of_month.replace(hour=0, minute=0, second=0)
+        # The timestamps are for the month in UTC, whatever the local timezone is
         last_day_of_month = last_day_of_month.replace(hour=23, minute=59, second=59)
-        start_of_month = int(first_day_of_month.timestamp())
-        end_of_month = int(last_day_of_month.timestamp())
+        start_of_month = calendar.timegm(first_day_of_month.timetuple())
+        end_of_month = calendar.timegm(last_day_of_month.timetuple())
     elif output_format == "date":
         start_of_month = first_day_of_month.date()
         end_of_month = last_day_of_month.date()
@@ -101,12 +239,27 @@ def get_month_range(date_input=None, output_format="timestamp"):
     return start_of_month, end_of_month
 
 
+@functools.lru_cache(maxsize=1024)
 def to_snake_case(value):
     """
     Converts a string to snake_case.
 
-    :param s: A string.
+    An underscore is added before each capital letter that follows a lowercase letter or digit,
+    or that starts a capitalized word, so "HTTPServerError" becomes "http_server_error".
+
+    :param value: A string.
     :return: The string in snake_case.
     """
-    value = re.sub("(.)([A-Z][a-z]+)", r"\1_\2", value)
-    return re.sub("([a-z0-9])([A-Z])", r"\1_\2", value).lower()
+    characters = []
+    for index, character in enumerate(value):
+        if "A" <= character <= "Z" and index > 0:
+            previous_character = value[index - 1]
+            next_character = value[index + 1] if index + 1 < len(value) else ""
+            if (
+                "a" <= previous_character <= "z"
+                or "0" <= previous_character <= "9"
+                or "a" <= next_character <= "z"
+            ):
+                characters.append("_")
+        characters.append(character)
+    return "".join(characters).lower()
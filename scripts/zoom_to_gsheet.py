@@ -4,20 +4,59 @@
 """Write Zoom meeting data to Google Sheets."""
 
 import argparse
+import functools
 import json
-from datetime import datetime
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from urllib.parse import quote
 
 import gspread
-import pandas as pd
-import requests
 from dotenv import load_dotenv
 from oauth2client.service_account import ServiceAccountCredentials
 from refresh_zoom_access_tokens import refresh_access_tokens
-from utilities import backoff, get_month_range, get_previous_month, to_snake_case
+from utilities import backoff, create_session, disk_cache, get_month_range, get_previous_month, to_snake_case
 
 load_dotenv()  # take environment variables from .env.
 
-ONE_WEEK_IN_SECONDS = 604800
+SPREADSHEET_ID = "1xREkcJwIP_iXblEkoTXoDqFWoLP7i6O2ZFdF2zn0tIA"
+
+ONE_WEEK = timedelta(weeks=1)
+
+# Number of meetings to process concurrently, kept low to stay under the Zoom rate limits
+MAX_WORKERS = 8
+
+# Keep the connections to Zoom alive between requests, retrying rate-limited and failed ones. Requests
+# that still fail return their last response, so the callers can report and skip them
+SESSION = create_session(pool_maxsize=MAX_WORKERS, raise_on_status=False)
+
+# The meeting data written to each sheet
+SHEET_KEYS = {
+    "Meetings": "meeting_count",
+    "Time in Meetings": "hours_in_meetings",
+    "Ad-hoc Meetings": "ad_hoc_meeting_count",
+}
+
+
+@dataclass
+class MeetingStats:
+    """The meeting data of an engineer."""
+
+    meeting_count: int = 0
+    hours_in_meetings: float = 0.0
+    ad_hoc_meeting_count: int = 0
+
+    def merge(self, other):
+        """
+        Add the meeting data of another MeetingStats to this one.
+
+        Args:
+            other (MeetingStats): The meeting data to add.
+        """
+        self.meeting_count += other.meeting_count
+        self.hours_in_meetings += other.hours_in_meetings
+        self.ad_hoc_meeting_count += other.ad_hoc_meeting_count
 
 
 def get_google_credentials():
@@ -44,44 +83,59 @@ def get_name_map(credentials):
     Returns:
         dict: A dictionary with name as keys and dictionaries with data from other columns as values.
     """
-    google = gspread.authorize(credentials)
-    spreadsheet = backoff(google.open_by_key, args=("1xREkcJwIP_iXblEkoTXoDqFWoLP7i6O2ZFdF2zn0tIA",))
-    aliases = pd.DataFrame(spreadsheet.worksheet("Aliases").get_all_records())
+    records = get_worksheet(credentials, "Aliases").get_all_records()
+    if not records:
+        return {}
 
-    # create map with name as key and a dictionary with data from other columns as values
+    # create map with name as key and a dictionary with data from the columns after the first two as values
+    columns = list(records[0])[2:]
     name_map = {
-        row["Engineer - IC"]: {
-            to_snake_case(col): row[col] for col in aliases.columns if aliases.columns.get_loc(col) > 1
-        }
-        for _, row in aliases.iterrows()
+        record["Engineer - IC"]: {to_snake_case(column): record[column] for column in columns}
+        for record in records
     }
 
     return name_map
 
 
-def participant_in_name_map(participant, name_map):
+def get_alias_index(name_map):
     """
-    Check if a participant's email or name is in the name map.
+    Index the engineers by each of their aliases, such as their email addresses.
 
     Args:
-        participant (dict): A dictionary with participant data.
         name_map (dict): A dictionary with engineer names as keys and dictionaries with other data as values.
 
     Returns:
-        bool, dict: A boolean indicating if the participant is in the name map, and the participant
-                    info if they are.
+        dict: A dictionary with lowercase aliases as keys and engineer names as values.
     """
-    for _, info in name_map.items():
-        for _, value in info.items():
-            if value in (participant["user_email"], participant["name"]):
-                return True, info
+    alias_index = {}
+    for full_name, info in name_map.items():
+        for value in info.values():
+            # Blank aliases would match every participant without an email address
+            if isinstance(value, str) and value:
+                alias_index.setdefault(value.lower(), full_name)
 
-    return False, None
+    return alias_index
+
+
+def participant_in_name_map(participant, alias_index):
+    """
+    Find the engineer whose aliases include a participant's email or name.
+
+    Args:
+        participant (dict): A dictionary with participant data.
+        alias_index (dict): A dictionary with lowercase aliases as keys and engineer names as values.
+
+    Returns:
+        str: The engineer's name, or None if the participant is not an engineer.
+    """
+    email = (participant.get("user_email") or "").lower()
+    name = (participant.get("name") or "").lower()
+    return alias_index.get(email) or alias_index.get(name)
 
 
 def make_request(url, headers, params):
     """
-    Send a HTTP GET request with retries in case of failure.
+    Send a HTTP GET request through the shared session, which retries it in case of failure.
 
     Args:
         url (str): The URL to send the request to.
@@ -91,102 +145,208 @@ def make_request(url, headers, params):
     Returns:
         Response: The response to the request.
     """
-    return backoff(
-        requests.get,
-        args=(url,),
-        kwargs={"headers": headers, "params": params},
-    )
+    return SESSION.get(url, headers=headers, params=params, timeout=30)
+
+
+def parse_zoom_datetime(value):
+    """
+    Parse a date and time returned by the Zoom API.
+
+    Args:
+        value (str): The date and time in ISO 8601 format, such as '2023-06-01T17:00:00Z'.
+
+    Returns:
+        datetime: The parsed date and time, or None if there is no value.
+    """
+    if not value:
+        return None
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
 
 
-def process_participant(participant, name_map, meeting_info, is_adhoc, result):
+def parse_duration(duration):
+    """
+    Convert a meeting duration returned by the Zoom API to minutes.
+
+    Args:
+        duration (int, str): The duration in minutes, or formatted as 'HH:MM:SS' or 'MM:SS'.
+
+    Returns:
+        float: The duration in minutes.
+    """
+    if not isinstance(duration, str):
+        return float(duration)
+
+    seconds = 0.0
+    for part in duration.split(":"):
+        seconds = seconds * 60 + float(part)
+    return seconds / 60
+
+
+def process_participant(full_name, meeting_info, is_adhoc, result):
     """
     Process participant data, including updating the participant's meeting count and hours in meetings.
 
     Args:
-        participant (dict): A dictionary with participant data.
-        name_map (dict): A dictionary with engineer names as keys and dictionaries with other data as values.
+        full_name (str): The name of the engineer who participated in the meeting.
         meeting_info (dict): A dictionary containing details about the meeting, including its duration.
         is_adhoc (bool): A flag indicating if the meeting is ad hoc.
         result (dict): The result dictionary to be updated.
 
     Note: The function will directly modify the result dictionary.
     """
-    if participant_in_name_map(participant, name_map)[0]:
-        _, participant_info = participant_in_name_map(participant, name_map)
+    stats = result[full_name]
+    stats.meeting_count += 1
+    stats.hours_in_meetings += meeting_info["duration"] / 60  # Convert minutes to hours
+    if is_adhoc:
+        stats.ad_hoc_meeting_count += 1
 
-        if not participant_info:
-            print(f"Could not find participant information for participant {participant}.")
-            return
 
-        full_name = next((key for key, value in name_map.items() if value == participant_info), None)
+def get_meeting_path_id(meeting):
+    """
+    Get the identifier to use for a past meeting in Zoom API paths.
 
-        print(f"Processing meeting for {full_name}...")
+    The UUID identifies this instance of the meeting, while the ID of a recurring meeting refers to its
+    latest instance. Zoom requires UUIDs that begin with '/' or contain '//' to be URL encoded twice.
 
-        result[full_name]["meeting_count"] += 1
-        result[full_name]["hours_in_meetings"] += meeting_info["duration"] / 60  # Convert minutes to hours
-        if is_adhoc:
-            result[full_name]["ad_hoc_meeting_count"] += 1
+    Args:
+        meeting (dict): A dictionary containing meeting data.
+
+    Returns:
+        str: The URL encoded UUID of the meeting, or its ID if it has no UUID.
+    """
+    uuid = meeting.get("uuid")
+    if not uuid:
+        return str(meeting["id"])
+    if uuid.startswith("/") or "//" in uuid:
+        uuid = quote(uuid, safe="")
+    return quote(uuid, safe="")
 
 
-def process_meeting(meeting, headers, name_map, result):
+def get_participants(meeting, headers):
     """
-    Process data for each meeting including each participant's information.
+    Fetch every participant of a past meeting.
 
     Args:
         meeting (dict): A dictionary containing meeting data.
         headers (dict): Request headers for the Zoom API.
-        name_map (dict): A dictionary with engineer names as keys and dictionaries with other data as values.
-        result (dict): The result dictionary to be updated.
 
-    Note: The function will directly modify the result dictionary.
+    Returns:
+        list: The participants of the meeting, or None if they could not be fetched.
     """
     params_participants = {"page_size": 300}
-
-    all_participants = []
+    participants = []
 
     while True:
-        participant_info = make_request(
-            f"https://api.zoom.us/v2/past_meetings/{meeting['id']}/participants", headers, params_participants
-        ).json()
+        response = make_request(
+            f"https://api.zoom.us/v2/past_meetings/{get_meeting_path_id(meeting)}/participants",
+            headers,
+            params_participants,
+        )
+        if response.status_code != 200:
+            print(f"Could not fetch the participants of meeting {meeting['id']}: {response.status_code}")
+            return None
 
+        participant_info = response.json()
         if "participants" not in participant_info:
-            break
+            print(f"Could not fetch the participants of meeting {meeting['id']}: {participant_info}")
+            return None
 
-        all_participants.extend(participant_info["participants"])
+        participants.extend(participant_info["participants"])
 
         if "next_page_token" in participant_info and participant_info["next_page_token"]:
             params_participants["next_page_token"] = participant_info["next_page_token"]
         else:
             break
 
-    # Fetch detailed meeting info
-    response = make_request(f"https://api.zoom.us/v2/past_meetings/{meeting['id']}", headers, {})
-    if response.status_code == 200 and response.text:
-        try:
-            meeting_info = response.json()
-        except json.JSONDecodeError:
-            print(f"Failed to decode JSON. Response was: {response.text}")
-            return
-    else:
+    return participants
+
+
+def get_meeting_info(meeting, headers):
+    """
+    Fetch the details of a past meeting.
+
+    Args:
+        meeting (dict): A dictionary containing meeting data.
+        headers (dict): Request headers for the Zoom API.
+
+    Returns:
+        dict: The details of the meeting, or None if they could not be fetched or have no type.
+    """
+    response = make_request(
+        f"https://api.zoom.us/v2/past_meetings/{get_meeting_path_id(meeting)}", headers, {}
+    )
+    if response.status_code != 200 or not response.text:
         print(f"Error: Received status code {response.status_code}")
-        return
+        return None
 
-    # Check if the meeting is ad hoc
-    created_at = pd.to_datetime(meeting_info.get("created_at"))
-    start_time = pd.to_datetime(meeting["start_time"])
+    try:
+        meeting_info = response.json()
+    except json.JSONDecodeError:
+        print(f"Failed to decode JSON. Response was: {response.text}")
+        return None
 
-    if meeting_info and "type" not in meeting_info:
+    if "type" not in meeting_info:
         print(f"Meeting {meeting['id']} does not have a type.")
         print(f"Meeting info: {meeting_info}")
-        return
-    is_adhoc = (
-        meeting_info["type"] == 1
-        or (created_at and start_time and (start_time - created_at).total_seconds() <= ONE_WEEK_IN_SECONDS)
-        or meeting["topic"].endswith("Zoom Meeting")
-    )
+        return None
 
-    for participant in all_participants:
-        process_participant(participant, name_map, meeting_info, is_adhoc, result)
+    return meeting_info
+
+
+def process_meeting(meeting, headers, alias_index):
+    """
+    Process data for each meeting including each participant's information. The participants and details
+    of past meetings never change, so they are cached on disk and only fetched once across runs.
+
+    Args:
+        meeting (dict): A dictionary containing meeting data.
+        headers (dict): Request headers for the Zoom API.
+        alias_index (dict): A dictionary with lowercase aliases as keys and engineer names as values.
+
+    Returns:
+        dict: The MeetingStats of the engineers who attended the meeting, keyed by their full name.
+    """
+    result = defaultdict(MeetingStats)
+    meeting_key = meeting.get("uuid") or str(meeting["id"])
+
+    # The list reports how many people joined, so meetings nobody joined need no requests at all
+    if meeting.get("participants") == 0:
+        return result
+
+    participants = disk_cache("zoom_participants", meeting_key, get_participants, args=(meeting, headers))
+    if not participants:
+        return result
+
+    # Only engineers are counted, so there is nothing to fetch or count if none of them attended
+    engineer_names = []
+    for participant in participants:
+        full_name = participant_in_name_map(participant, alias_index)
+        if full_name:
+            engineer_names.append(full_name)
+    if not engineer_names:
+        return result
+
+    if meeting["topic"].endswith("Zoom Meeting") or meeting.get("type") == 1:
+        # The list already shows the meeting is ad hoc and has its duration, so skip fetching its details
+        meeting_info = {"duration": parse_duration(meeting.get("duration", 0))}
+        is_adhoc = True
+    else:
+        meeting_info = disk_cache("zoom_meetings", meeting_key, get_meeting_info, args=(meeting, headers))
+        if not meeting_info:
+            return result
+
+        # Check if the meeting is ad hoc
+        created_at = parse_zoom_datetime(meeting_info.get("created_at"))
+        start_time = parse_zoom_datetime(meeting["start_time"])
+        is_adhoc = meeting_info["type"] == 1 or (
+            created_at and start_time and start_time - created_at <= ONE_WEEK
+        )
+
+    print(f"Processing meeting {meeting['id']} for {len(engineer_names)} engineers...")
+    for full_name in engineer_names:
+        process_participant(full_name, meeting_info, is_adhoc, result)
+
+    return result
 
 
 def get_zoom_meeting_data(headers, name_map, start_of_month, end_of_month):
@@ -210,97 +370,150 @@ def get_zoom_meeting_data(headers, name_map, start_of_month, end_of_month):
         "type": "past",
     }
 
-    result = {}
-    for name in name_map:
-        result[name] = {"meeting_count": 0, "hours_in_meetings": 0.0, "ad_hoc_meeting_count": 0}
+    alias_index = get_alias_index(name_map)
+
+    result = {name: MeetingStats() for name in name_map}
 
     meeting_processed = 0
-    while True:
-        response = make_request("https://api.zoom.us/v2/metrics/meetings", headers, params)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        while True:
+            response = make_request("https://api.zoom.us/v2/metrics/meetings", headers, params)
 
-        # check if request was successful
-        if response.status_code != 200:
-            print(f"Error: Received status code {response.status_code}")
-            print(f"Response: {response.json()}")
-            break
+            # check if request was successful
+            if response.status_code != 200:
+                print(f"Error: Received status code {response.status_code}")
+                print(f"Response: {response.text}")
+                break
 
-        meetings_data = response.json()
+            meetings_data = response.json()
 
-        for meeting in meetings_data["meetings"]:
-            meeting_processed += 1
-            process_meeting(meeting, headers, name_map, result)
+            # Process the meetings of the page concurrently, then merge their data
+            meeting_results = executor.map(
+                lambda meeting: process_meeting(meeting, headers, alias_index), meetings_data["meetings"]
+            )
+            for meeting_result in meeting_results:
+                meeting_processed += 1
+                for name, stats in meeting_result.items():
+                    result[name].merge(stats)
 
-        print(f"Processed {meeting_processed} meetings...")
+            print(f"Processed {meeting_processed} meetings...")
 
-        if "next_page_token" in meetings_data and meetings_data["next_page_token"]:
-            params["next_page_token"] = meetings_data["next_page_token"]
-        else:
-            break
+            if "next_page_token" in meetings_data and meetings_data["next_page_token"]:
+                params["next_page_token"] = meetings_data["next_page_token"]
+            else:
+                break
 
     return result
 
 
-def get_month_index(worksheet, month_converted):
+@functools.lru_cache(maxsize=1)
+def get_spreadsheet(credentials):
     """
-    Get the index of the column with the month in a Google Sheets worksheet.
+    Authorizes with Google Sheets and opens the spreadsheet. The handle is memoized so the
+    authorization and lookup only happen once per run.
 
     Args:
-        worksheet (gspread.models.Worksheet): The worksheet to find the column index in.
-        month_converted (str): The month to find the column index of, formatted as 'Month Year'.
+        credentials (ServiceAccountCredentials): Google Sheets credentials.
 
     Returns:
-        int: The index of the column with the month.
+        gspread.Spreadsheet: The spreadsheet.
     """
-    return worksheet.row_values(1).index(month_converted) + 1
+    google = gspread.authorize(credentials)
+    return backoff(google.open_by_key, args=(SPREADSHEET_ID,), max_retries=30)
 
 
-def get_user_row_index(worksheet, full_name):
+@functools.lru_cache(maxsize=None)
+def get_worksheet(credentials, sheet_name):
     """
-    Get the index of the row with the engineer's name in a Google Sheets worksheet.
+    Gets a worksheet from the spreadsheet. The handle is memoized per sheet name.
 
     Args:
-        worksheet (gspread.models.Worksheet): The worksheet to find the row index in.
-        full_name (str): The name of the engineer.
+        credentials (ServiceAccountCredentials): Google Sheets credentials.
+        sheet_name (str): The name of the worksheet.
 
     Returns:
-        int: The index of the row with the engineer's name.
+        gspread.Worksheet: The worksheet.
     """
-    return worksheet.col_values(1).index(full_name) + 1
+    return backoff(get_spreadsheet(credentials).worksheet, args=(sheet_name,), max_retries=30)
 
 
-def update_google_sheet(credentials, full_name, data, sheet_name, month):
+@functools.lru_cache(maxsize=1)
+def get_cell_indexes(credentials):
     """
-    Update the Google Sheet with the new meeting data.
+    Gets the index of the column of each month and the row of each engineer in every metrics sheet.
+    The header rows and name columns of all the sheets are read in a single request, once per run.
 
     Args:
         credentials (ServiceAccountCredentials): Google Sheets credentials.
-        full_name (str): The full name of the engineer.
-        data (int, float): The meeting data to write to the sheet.
-        sheet_name (str): The name of the sheet to write the data to.
-        month (str): The month the data pertains to, formatted as 'YYYY-MM'.
+
+    Returns:
+        dict: Tuples of the 1-based column indexes keyed by the month formatted as 'Month Year', and the
+              1-based row indexes keyed by the full name of the engineer, keyed by sheet name.
     """
-    google = gspread.authorize(credentials)
-    spreadsheet = backoff(
-        google.open_by_key, args=("1xREkcJwIP_iXblEkoTXoDqFWoLP7i6O2ZFdF2zn0tIA",), max_retries=30
-    )
-    worksheet = backoff(spreadsheet.worksheet, args=(sheet_name,), max_retries=30)
+    ranges = []
+    for sheet_name in SHEET_KEYS:
+        ranges.extend([f"'{sheet_name}'!1:1", f"'{sheet_name}'!A:A"])
+    value_ranges = backoff(get_spreadsheet(credentials).values_batch_get, args=(ranges,))["valueRanges"]
+
+    cell_indexes = {}
+    for index, sheet_name in enumerate(SHEET_KEYS):
+        header_rows = value_ranges[2 * index].get("values", [])
+        name_rows = value_ranges[2 * index + 1].get("values", [])
+
+        month_col_indexes = {}
+        for col_index, month_converted in enumerate(header_rows[0] if header_rows else [], start=1):
+            month_col_indexes.setdefault(month_converted, col_index)
+
+        user_row_indexes = {}
+        for row_index, row in enumerate(name_rows, start=1):
+            if row:
+                user_row_indexes.setdefault(row[0], row_index)
+
+        cell_indexes[sheet_name] = (month_col_indexes, user_row_indexes)
+
+    return cell_indexes
+
 
+def update_google_sheets(credentials, month, meeting_data):
+    """
+    Update the Google Sheets with the new meeting data of every engineer in a single request.
+
+    Args:
+        credentials (ServiceAccountCredentials): Google Sheets credentials.
+        month (str): The month the data pertains to, formatted as 'YYYY-MM'.
+        meeting_data (dict): The MeetingStats to write, keyed by the full name of the engineer.
+    """
     month_converted = datetime.strptime(month, "%Y-%m").strftime("%B %Y")
 
-    # get the index of the column with the month
-    month_col_index = backoff(get_month_index, args=(worksheet, month_converted))
-
-    # get the index of the row with the user id
-    user_row_index = backoff(get_user_row_index, args=(worksheet, full_name))
-    # write the data to the cell
-    backoff(
-        worksheet.update_cell,
-        args=(
-            user_row_index,
-            month_col_index,
-            data,
-        ),
-    )
+    cells = []
+    for sheet_name, key in SHEET_KEYS.items():
+        month_col_indexes, user_row_indexes = get_cell_indexes(credentials)[sheet_name]
+        if month_converted not in month_col_indexes:
+            raise ValueError(f"Could not find {month_converted} in the {sheet_name} sheet.")
+        month_col_index = month_col_indexes[month_converted]
+
+        for full_name, data in meeting_data.items():
+            if full_name not in user_row_indexes:
+                print(f"Could not find {full_name} in the {sheet_name} sheet.")
+                continue
+            cells.append(
+                (sheet_name, gspread.Cell(user_row_indexes[full_name], month_col_index, getattr(data, key)))
+            )
+
+    # Write the cells of every sheet in a single request
+    if cells:
+        backoff(
+            get_spreadsheet(credentials).values_batch_update,
+            kwargs={
+                "body": {
+                    "valueInputOption": "USER_ENTERED",
+                    "data": [
+                        {"range": f"'{sheet_name}'!{cell.address}", "values": [[cell.value]]}
+                        for sheet_name, cell in cells
+                    ],
+                }
+            },
+        )
 
 
 def get_argument_parser():
@@ -337,16 +550,8 @@ def main():
         meeting_data = get_zoom_meeting_data(headers, name_map, start_of_month, end_of_month)
 
         # Write the data to the Google Sheets
-        for full_name, data in meeting_data.items():
-            print(f"Updating {full_name} for {month}...")
-            print(f"Data: {data}")
-            update_google_sheet(google_credentials, full_name, data["meeting_count"], "Meetings", month)
-            update_google_sheet(
-                google_credentials, full_name, data["hours_in_meetings"], "Time in Meetings", month
-            )
-            update_google_sheet(
-                google_credentials, full_name, data["ad_hoc_meeting_count"], "Ad-hoc Meetings", month
-            )
+        print(f"Updating {len(meeting_data)} engineers for {month}...")
+        update_google_sheets(google_credentials, month, meeting_data)
 
 
 if __name__ == "__main__":